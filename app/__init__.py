@@ -112,6 +112,37 @@ def create_app():
 
             compile_static_assets(assets)
 
+            from app.utils.vector_cache import VectorCache
+
+            VectorCache.configure(
+                max_bytes=app.config["VECTOR_CACHE_MAX_BYTES"],
+                ann_min_rows=app.config["VECTOR_ANN_MIN_ROWS"],
+                ann_nprobe=app.config["VECTOR_ANN_NPROBE"],
+                cache_format=app.config["VECTOR_CACHE_FORMAT"],
+                coarse_dimensions=app.config["VECTOR_COARSE_DIMENSIONS"],
+                coarse_candidates=app.config["VECTOR_COARSE_CANDIDATES"],
+                route_fanout=app.config["VECTOR_ROUTE_FANOUT"],
+                route_min_rows=app.config["VECTOR_ROUTE_MIN_ROWS"],
+            )
+
+            from app.utils.search_batcher import SearchBatcher
+
+            SearchBatcher.configure(
+                window=app.config["VECTOR_SEARCH_BATCH_WINDOW_MS"] / 1000,
+                max_batch=app.config["VECTOR_SEARCH_MAX_BATCH"],
+            )
+
+            from app.utils.query_embedding_cache import QueryEmbeddingCache
+
+            QueryEmbeddingCache.configure(
+                max_entries=app.config["QUERY_EMBEDDING_CACHE_SIZE"],
+                directory=app.config["QUERY_EMBEDDING_CACHE_DIR"],
+            )
+
+            from app.utils.chunk_embedding_cache import ChunkEmbeddingCache
+
+            ChunkEmbeddingCache.configure(enabled=app.config["CHUNK_EMBEDDING_CACHE_ENABLED"])
+
             @app.teardown_request
             def session_teardown(exception=None):
                 if exception:
@@ -22,6 +22,8 @@ class Document(db.Model, SoftDeleteMixin, TimestampMixin):
     total_tokens = db.Column(db.Integer, nullable=False)
     pages = db.Column(db.String(255), nullable=True)
     selected = db.Column(db.Boolean, default=False)
+    centroid = db.Column(db.LargeBinary, nullable=True)  # Unit-length float32 mean of the chunk embeddings
+    file_hash = db.Column(db.String(64), nullable=True, index=True)  # SHA-256 of the uploaded file
     chunks = db.relationship(
         "DocumentChunk",
         back_populates="document",
@@ -64,6 +66,8 @@ class DocumentEmbedding(db.Model, TimestampMixin):
     chunk = db.relationship("DocumentChunk", back_populates="embedding")
     embedding = db.Column(db.LargeBinary, nullable=False)
     model = db.Column(db.String(50), nullable=False)
+    storage_format = db.Column(db.String(16), nullable=False, default="float32", server_default="float32")
+    scale = db.Column(db.Float, nullable=True)  # Per-vector scale for int8 storage
     document = db.relationship(
         "Document",
         secondary="document_chunks",
@@ -72,3 +76,51 @@ class DocumentEmbedding(db.Model, TimestampMixin):
         viewonly=True,
         backref=backref("embeddings", cascade="all, delete-orphan"),
     )
+
+
+class EmbeddingCacheEntry(db.Model, TimestampMixin):
+    """Embedding shared by every chunk with the same normalised text, chunk size and model."""
+
+    __tablename__ = "embedding_cache_entries"
+    content_hash = db.Column(db.String(64), primary_key=True)
+    model = db.Column(db.String(50), nullable=False)
+    embedding = db.Column(db.LargeBinary, nullable=False)  # Full-precision float32, whatever the storage format
+
+
+class PreprocessedChunk(db.Model, TimestampMixin):
+    """GPT-cleaned text of a chunk, keyed by sha256 of (model, prompt version, raw chunk text)."""
+
+    __tablename__ = "preprocessed_chunks"
+    text_hash = db.Column(db.String(64), primary_key=True)
+    model = db.Column(db.String(50), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+
+
+class EmbeddingMigration(db.Model, TimestampMixin):
+    """Re-embedding of one user's chunks under another model, see app.tasks.embedding_migration_task."""
+
+    __tablename__ = "embedding_migrations"
+    id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
+    user_id = db.Column(db.String(36), db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    model = db.Column(db.String(50), nullable=False)
+    dimensions = db.Column(db.Integer, nullable=True)  # None for the model's native size
+    # pending, running, completed, failed or cancelled (superseded by a newer migration of the same user)
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    embedded_chunks = db.Column(db.Integer, nullable=False, default=0)
+    embedded_tokens = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+
+class ShadowEmbedding(db.Model, TimestampMixin):
+    """Embedding of a chunk under a model it is being migrated to; copied into document_embeddings on the flip."""
+
+    __tablename__ = "shadow_embeddings"
+    chunk_id = db.Column(
+        db.String(36), db.ForeignKey("document_chunks.id", ondelete="CASCADE"), primary_key=True
+    )
+    model = db.Column(db.String(50), primary_key=True)  # DocumentEmbedding.model value, see embedding_model_name()
+    user_id = db.Column(db.String(36), db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    embedding = db.Column(db.LargeBinary, nullable=False)
+    storage_format = db.Column(db.String(16), nullable=False, default="float32")
+    scale = db.Column(db.Float, nullable=True)
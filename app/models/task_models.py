@@ -51,6 +51,14 @@ class EmbeddingTask(db.Model):
     chunk_size = db.Column(db.Integer)
     temp_path = db.Column(db.String(255))
     advanced_preprocessing = db.Column(db.Boolean, default=False)
+    file_hash = db.Column(db.String(64))  # SHA-256 of the upload, computed while it was saved
+    # Checkpoint of an interrupted run: every chunk before resume_chunk_index is stored, and splitting can restart
+    # at resume_page. resume_page is None once the document has finished or been discarded.
+    document_id = db.Column(db.String(36))
+    resume_page = db.Column(db.Integer)
+    resume_chunk_index = db.Column(db.Integer)
+    # Page-range tasks a large PDF was fanned out into; None once the chord's finalize or error callback has run
+    parts_pending = db.Column(db.Integer)
 
     def __repr__(self):
         return f"<EmbeddingTask {self.id} - {self.title}>"
@@ -68,6 +68,11 @@ class User(UserMixin, SoftDeleteMixin, db.Model, TimestampMixin):
     login_method = db.Column(db.String(10), nullable=False, default="None")
     reset_token_hash = db.Column(db.String(255), nullable=True)
     color_mode = db.Column(db.String(10), nullable=False, default="dark")
+    vector_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # Bumped when documents change
+    # Model and output size of the user's document and query embeddings; None means EMBEDDING_MODEL at native size.
+    # Only an EmbeddingMigration changes them, in the transaction that swaps in the re-embedded vectors.
+    embedding_model = db.Column(db.String(50), nullable=True)
+    embedding_dimensions = db.Column(db.Integer, nullable=True)
 
     selected_api_key_id = db.Column(db.String(36), db.ForeignKey("user_api_keys.id"), nullable=True)
 
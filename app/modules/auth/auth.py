@@ -199,8 +199,8 @@ def confirm_email():
 @auth_bp.route("/logout")
 @login_required
 def logout():
+    VectorCache.evict_user(current_user.id)
     logout_user()
-    VectorCache.clear_cache()
     return redirect(url_for(".login"))
 
 
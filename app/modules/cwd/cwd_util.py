@@ -1,75 +1,51 @@
-from typing import List
-import numpy as np
-import openai
+import time
 from flask_login import current_user
 from openai import RateLimitError
 from app import db, socketio
 from app.models.chat_models import ChatPreferences
-from app.models.embedding_models import DocumentChunk, Document, ModelContextWindow
-from app.utils.vector_cache import VectorCache
+from app.modules.embedding.embedding_util import (
+    embedding_kwargs,
+    fetch_chunk_details,
+    get_query_embedding,
+    select_within_budget,
+    user_embedding_model,
+)
+from app.utils.logging_util import configure_logging
+from app.utils.search_batcher import SearchBatcher
+
+logger = configure_logging()
 
 
 def find_relevant_sections(user_id, query_embedding, user_preferences):
+    started = time.perf_counter()
     context_window_size = 120000
     max_sections = user_preferences.top_k
     threshold = user_preferences.threshold
+    prepared = time.perf_counter()
 
-    document_chunks_with_details = (
-        db.session.query(
-            DocumentChunk.id,
-            Document.title,
-            Document.author,
-            DocumentChunk.pages,
-            DocumentChunk.content,  # Include the chunk content
-            DocumentChunk.tokens,
-        )
-        .join(Document)
-        .filter(Document.user_id == user_id, Document.selected == 1)
-        .all()
-    )
-
-    # Get the IDs of the chunks for the current user's documents
-    subset_ids = [str(chunk.id) for chunk in document_chunks_with_details]
-
-    # Get a descending list of similarities for the subset using the MIPS naive method
-    similarities = VectorCache.mips_naive(query_embedding, subset_ids)
+    # Get the highest scoring chunks of the selected documents, best first, from the cache's selection mask
+    similarities = SearchBatcher.top_k(user_id, query_embedding, max_sections)
+    ranked = time.perf_counter()
 
-    # Filter out any similarities below the threshold
+    # Filter out any similarities below the threshold, then fetch content only for what fits the context window
     filtered_similarities = [(chunk_id, sim) for chunk_id, sim in similarities if sim >= threshold]
-
-    # Select chunks based on the max number of sections, token limit, and similarity threshold
-    selected_chunks = []
-    sections_appended = 0
-    current_tokens = 0
-
-    for chunk_id, similarity in filtered_similarities:
-        if sections_appended >= max_sections:
-            break
-
-        chunk = next((c for c in document_chunks_with_details if str(c.id) == chunk_id), None)
-        if chunk and current_tokens + chunk.tokens <= context_window_size:
-            selected_chunks.append(
-                (chunk.id, chunk.title, chunk.author, chunk.pages, chunk.content, chunk.tokens, similarity)
-            )
-            current_tokens += chunk.tokens
-            sections_appended += 1
-        elif chunk:
-            break
-
+    winners = select_within_budget(user_id, filtered_similarities, max_sections, context_window_size)
+    budgeted = time.perf_counter()
+    selected_chunks = fetch_chunk_details(winners)
+    fetched = time.perf_counter()
+
+    logger.info(
+        f"CWD retrieval for user {user_id}: prepare {(prepared - started) * 1000:.1f} ms, "
+        f"rank {(ranked - prepared) * 1000:.1f} ms, budget {(budgeted - ranked) * 1000:.1f} ms, "
+        f"content {(fetched - budgeted) * 1000:.1f} ms, {len(selected_chunks)} chunks"
+    )
     return selected_chunks
 
 
-def get_embedding(text: str, client: openai.OpenAI, model="text-embedding-3-large", **kwargs) -> List[float]:
-    response = client.embeddings.create(input=text, model=model, **kwargs)
-    embedding = response.data[0].embedding
-    if len(embedding) != 3072:
-        raise ValueError(f"Expected embedding dimension to be 3072, but got {len(embedding)}")
-    return embedding
-
-
 def append_knowledge_context(user_query, user_id, client):
-    query_embedding = get_embedding(user_query, client)
-    query_vector = np.array(query_embedding, dtype=np.float32)
+    # Embed the user query with the model of the user's document vectors
+    model, dimensions = user_embedding_model(db.session, user_id)
+    query_vector = get_query_embedding(user_query, client, model, **embedding_kwargs(dimensions))
     user_preferences = db.session.query(ChatPreferences).filter_by(user_id=user_id).one()
 
     relevant_sections = find_relevant_sections(user_id, query_vector, user_preferences=user_preferences)
@@ -13,6 +13,7 @@ from app.models.task_models import EmbeddingTask, Task
 from app.modules.embedding.embedding_util import save_temp
 from app.utils.forms_util import DocumentUploadForm, EditDocumentForm, DeleteDocumentForm, UpdateDocPreferencesForm
 from app.utils.vector_cache import VectorCache
+from app.utils.vector_store import VectorStore
 
 # Initialize the blueprint
 embedding_bp = Blueprint(
@@ -72,14 +73,15 @@ def upload_document():
         chunk_size = int(chunk_sizes[i]) if i < len(chunk_sizes) else 512
         advanced_preprocessing = advanced_preprocessings[i] == 'true' if i < len(advanced_preprocessings) else False  # Convert to boolean
 
-        temp_path = save_temp(file)
+        temp_path, file_hash = save_temp(file)
 
         new_task = Task(type="Embedding", status="pending", user_id=current_user.id)
         db.session.add(new_task)
         db.session.flush()
 
         new_embedding_task = EmbeddingTask(
-            task_id=new_task.id, title=title, author=author, chunk_size=chunk_size, temp_path=temp_path, advanced_preprocessing=advanced_preprocessing
+            task_id=new_task.id, title=title, author=author, chunk_size=chunk_size, temp_path=temp_path, advanced_preprocessing=advanced_preprocessing,
+            file_hash=file_hash,
         )
         db.session.add(new_embedding_task)
 
@@ -117,7 +119,9 @@ def delete_document(document_id):
         return jsonify({"error": "Unauthorized or invalid form submission"}), 403
     try:
         document.delete = True
+        VectorCache.bump_version(db.session, current_user.id)
         db.session.commit()
+        VectorStore(current_user.id).add_tombstones([document.id])
         return (
             jsonify(
                 {"status": "success", "message": "Document deleted successfully."}
@@ -141,7 +145,9 @@ def delete_all_documents():
 
         for document in documents:
             document.delete = True
+        VectorCache.bump_version(db.session, current_user.id)
         db.session.commit()
+        VectorStore(current_user.id).add_tombstones([document.id for document in documents])
 
         return jsonify(
             {"status": "success", "message": "All documents deleted successfully.\nPlease refresh to see changes"}), 200
@@ -198,6 +204,7 @@ def update_document_selection():
         return jsonify({"error": "Unauthorized"}), 403
 
     document.selected = selected
+    VectorCache.bump_version(db.session, current_user.id)
     db.session.commit()
 
     return jsonify({"status": "success"})
@@ -242,9 +249,6 @@ def update_docs_preferences():
 
         # Update knowledge query mode
         chat_preferences.knowledge_query_mode = "knowledge_query_mode" in form_data
-        if chat_preferences.knowledge_query_mode:
-            VectorCache.load_user_vectors(current_user.id)
-
 
         chat_preferences.top_k = int(form_data.get("top_k", 0))
 
@@ -289,6 +293,7 @@ def update_docs_preferences():
                 document = Document.query.get(doc_id)
                 if document and document.user_id == current_user.id:
                     document.selected = True
+        VectorCache.bump_version(db.session, current_user.id)
 
         if "reset" in form_data:
             # Reset preferences to default values
@@ -300,6 +305,8 @@ def update_docs_preferences():
             chat_preferences.top_p = 1.0
         try:
             db.session.commit()
+            if chat_preferences.knowledge_query_mode:
+                VectorCache.load_user_vectors(current_user.id)
             return jsonify({"status": "success", "message": "Preferences updated successfully."})
         except Exception as e:
             db.session.rollback()
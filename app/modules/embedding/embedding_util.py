@@ -1,10 +1,17 @@
+import base64
+import bisect
 import concurrent
+import hashlib
+import itertools
 import os
 import re
+import threading
+import time
 import uuid
-from typing import List, Tuple, Set, Generator
+from typing import List, Tuple, Set
 from nltk.data import find
 
+from flask import current_app, has_app_context
 from flask_login import current_user
 
 from app.modules.user.user_util import get_user_upload_directory
@@ -14,19 +21,49 @@ import tiktoken
 from concurrent import futures
 from nltk.tokenize import word_tokenize, sent_tokenize
 from pypdf import PdfReader
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from tenacity import RetryError, retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from werkzeug.utils import secure_filename
 
 from app import db
-from app.models.embedding_models import ModelContextWindow, Document, DocumentChunk, DocumentEmbedding
+from app.models.embedding_models import (
+    ModelContextWindow,
+    Document,
+    DocumentChunk,
+    PreprocessedChunk,
+)
 from app.models.chat_models import ChatPreferences
+from app.models.mixins import generate_uuid
+from app.utils.embedding_model_util import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    embedding_kwargs,
+    embedding_model_name,
+    user_embedding_model,
+)
+from app.utils.pdf_extraction import iter_page_range, iter_pages_parallel
+from app.utils.quantization import encode_embedding
+from app.utils.query_embedding_cache import QueryEmbeddingCache, normalize_query
+from app.utils.search_batcher import SearchBatcher
 from app.utils.vector_cache import VectorCache
 from app.utils.logging_util import configure_logging
 
 logger = configure_logging()
 ENCODING = tiktoken.get_encoding("cl100k_base")
-EMBEDDING_MODEL = "text-embedding-3-large"
-MAX_TOKENS_PER_BATCH = 8000  # Define the maximum tokens per batch
-WORDS_PER_PAGE = 500  # Define the number of words per page
+MAX_TOKENS_PER_BATCH = 64000  # Tokens per embeddings request, well under the API's per-request limit
+MAX_INPUTS_PER_BATCH = 2048  # Inputs the embeddings API accepts in one request
+MAX_CONCURRENT_BATCHES = 4  # Embedding requests in flight per document
+WORDS_PER_PAGE = 500  # Words in a synthetic page of a .txt upload; pages end at the next sentence end after this
+TEXT_READ_BLOCK_SIZE = 64 * 1024  # Characters read from a .txt upload at a time
+INSERT_BATCH_ROWS = 1000  # Rows per executemany when writing chunks and embeddings
+UPLOAD_BLOCK_SIZE = 1024 * 1024  # Bytes read from an upload at a time while saving and hashing it
+CODE_EXTENSIONS = (".py", ".html", ".css", ".js", ".md", ".yml", ".json")  # Read whole and split by CodeTextSplitter
+GPT_PREPROCESS_MODEL = "gpt-3.5-turbo-0125"
+GPT_PREPROCESS_PROMPT_VERSION = 1  # Bump when the prompt changes so cached results of the old one are not reused
+GPT_PREPROCESS_ATTEMPTS = 5
+GPT_PREPROCESS_MAX_BACKOFF = 60  # Seconds
+GPT_PREPROCESS_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
 
 
 def download_nltk_data():
@@ -58,12 +95,17 @@ def extract_uuid_from_path(temp_path):
 
 
 def save_temp(uploaded_file):
+    """Save an upload to the user's directory and return its path and SHA-256, hashed while it is written."""
     temp_dir = get_user_upload_directory(current_user.id)
     file_extension = os.path.splitext(uploaded_file.filename)[1]
     uuid_filename = f"{uuid.uuid4()}{file_extension}"
     temp_path = os.path.join(temp_dir, secure_filename(uuid_filename))
-    uploaded_file.save(temp_path)
-    return temp_path
+    file_hash = hashlib.sha256()
+    with open(temp_path, "wb") as file:
+        for block in iter(lambda: uploaded_file.stream.read(UPLOAD_BLOCK_SIZE), b""):
+            file_hash.update(block)
+            file.write(block)
+    return temp_path, file_hash.hexdigest()
 
 
 def count_tokens(string: str) -> int:
@@ -83,7 +125,7 @@ def preprocess_text(text):
 
 def gpt_preprocess(text, client):
     completion = client.chat.completions.create(
-        model="gpt-3.5-turbo-0125",
+        model=GPT_PREPROCESS_MODEL,
         messages=[
             {
                 "role": "system",
@@ -101,112 +143,304 @@ def gpt_preprocess(text, client):
     return response
 
 
-def get_embedding(text: str, client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> List[float]:
-    response = client.embeddings.create(input=text, model=model, **kwargs)
-    embedding = response.data[0].embedding
-    if len(embedding) != 3072:
-        raise ValueError(f"Expected embedding dimension to be 3072, but got {len(embedding)}")
-    return embedding
+_preprocess_pool = None
+_preprocess_pool_workers = 0
+_preprocess_pool_lock = threading.Lock()
+_preprocess_backoff = wait_random_exponential(multiplier=1, max=GPT_PREPROCESS_MAX_BACKOFF)
 
 
-def get_embedding_batch(texts: List[str], client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> List[List[float]]:
-    embeddings = []
-    current_batch = []
-    current_tokens = 0
+def _get_preprocess_pool(workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    global _preprocess_pool, _preprocess_pool_workers
+    with _preprocess_pool_lock:
+        if _preprocess_pool is None or _preprocess_pool_workers != workers:
+            if _preprocess_pool is not None:
+                _preprocess_pool.shutdown(wait=False)
+            _preprocess_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="gpt-preprocess"
+            )
+            _preprocess_pool_workers = workers
+        return _preprocess_pool
 
-    def process_batch(batch):
-        return [get_embedding(text, client, model, **kwargs) for text in batch]
-
-    for text in texts:
-        text = text.replace("\n", " ")
-        token_estimate = count_tokens(text)
-        if current_tokens + token_estimate > MAX_TOKENS_PER_BATCH:
-            if current_batch:  # Ensure there is something to process
-                embeddings.append(current_batch)  # Prepare batch for processing
-            current_batch = [text]  # Start a new batch
-            current_tokens = token_estimate
-        else:
-            current_batch.append(text)
-            current_tokens += token_estimate
 
-    if current_batch:  # Check if there's a last batch to process
-        embeddings.append(current_batch)  # Prepare last batch for processing
+def _preprocess_wait(retry_state) -> float:
+    """Wait as long as a rate limit response asks to, otherwise back off exponentially with jitter."""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), GPT_PREPROCESS_MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return _preprocess_backoff(retry_state)
 
-    # Process all batches concurrently and flatten the result
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Map each batch to the executor for concurrent processing
-        results = list(executor.map(process_batch, embeddings))
-        # Flatten the list of lists to a single list of embeddings
-        final_embeddings = [item for sublist in results for item in sublist]
 
-    return final_embeddings
+@retry(
+    retry=retry_if_exception_type(GPT_PREPROCESS_RETRYABLE_ERRORS),
+    wait=_preprocess_wait,
+    stop=stop_after_attempt(GPT_PREPROCESS_ATTEMPTS),
+)
+def gpt_preprocess_with_retry(text, client) -> str:
+    return gpt_preprocess(text, client).content
 
 
-def store_embeddings(session, document_id, embeddings, user_id):
-    chunks = session.query(DocumentChunk).filter_by(document_id=document_id).all()
-    if len(chunks) != len(embeddings):
-        raise ValueError("The number of embeddings does not match the number of document chunks.")
+class ChunkPreprocessor:
+    """Cleans chunks with gpt_preprocess on a worker pool shared by every document in the process.
 
-    embedding_models = []
-    for chunk, embedding_vector in zip(chunks, embeddings):
-        embedding_bytes = np.array(embedding_vector, dtype=np.float32).tobytes()
-        embedding_model = DocumentEmbedding(
-            chunk_id=chunk.id, embedding=embedding_bytes, user_id=user_id, model=EMBEDDING_MODEL  # Store as binary data
+    Results are cached in preprocessed_chunks by sha256 of (model, prompt version, chunk text), so chunks of a
+    re-upload are not sent again. Rate limits and transient API errors are retried with backoff; a chunk that
+    still fails keeps its raw text. Counters cover one document, see report().
+    """
+
+    def __init__(self, client, engine=None, workers: int = None):
+        self.client = client
+        self.engine = engine  # Cache lookups run on their own connections; None disables the cache
+        self.workers = max(1, workers if workers is not None else current_app.config["GPT_PREPROCESS_WORKERS"])
+        self.pool = _get_preprocess_pool(self.workers)
+        self._lock = threading.Lock()
+        self.cached = 0
+        self.processed = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(
+            f"{GPT_PREPROCESS_MODEL}\n{GPT_PREPROCESS_PROMPT_VERSION}\n{text}".encode("utf-8")
+        ).hexdigest()
+
+    def _lookup(self, keys: list) -> dict:
+        if self.engine is None or not keys:
+            return {}
+        table = PreprocessedChunk.__table__
+        try:
+            with self.engine.connect() as connection:
+                rows = connection.execute(
+                    select(table.c.text_hash, table.c.content).where(table.c.text_hash.in_(list(set(keys))))
+                )
+                return dict(rows.all())
+        except SQLAlchemyError as e:
+            logger.error(f"Could not look up preprocessed chunks: {e}")
+            return {}
+
+    def _remember(self, key: str, content: str) -> None:
+        if self.engine is None:
+            return
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    insert(PreprocessedChunk), {"text_hash": key, "model": GPT_PREPROCESS_MODEL, "content": content}
+                )
+        except IntegrityError:
+            pass  # Another worker cleaned the same chunk first
+        except SQLAlchemyError as e:
+            logger.error(f"Could not cache a preprocessed chunk: {e}")
+
+    def _process(self, chunk: str, key: str) -> str:
+        try:
+            content = gpt_preprocess_with_retry(chunk, self.client)
+        except RetryError as e:
+            content = None
+            logger.error(f"Preprocessing a chunk still failed after {GPT_PREPROCESS_ATTEMPTS} attempts: {e}")
+        except Exception as e:
+            content = None
+            logger.error(f"An error occurred during preprocessing: {e}")
+        if not content or not content.strip():
+            with self._lock:
+                self.failed += 1
+            return chunk
+        content = content.strip()
+        self._remember(key, content)
+        with self._lock:
+            self.processed += 1
+        return content
+
+    def submit(self, chunks: List[str]) -> List[concurrent.futures.Future]:
+        """One future per chunk, in order, resolving to the cleaned text. Cached chunks resolve immediately."""
+        keys = [self.make_key(chunk) for chunk in chunks]
+        cached = self._lookup(keys)
+        results = []
+        for chunk, key in zip(chunks, keys):
+            if key in cached:
+                future = concurrent.futures.Future()
+                future.set_result(cached[key])
+                with self._lock:
+                    self.cached += 1
+            else:
+                future = self.pool.submit(self._process, chunk, key)
+            results.append(future)
+        return results
+
+    def process(self, chunks: List[str]) -> List[str]:
+        return [future.result() for future in self.submit(chunks)]
+
+    def report(self, document_id) -> None:
+        seconds = time.perf_counter() - self.started
+        total = self.cached + self.processed + self.failed
+        rate = total / seconds if seconds > 0 else 0.0
+        logger.info(
+            f"Preprocessed {total} chunks of document {document_id} in {seconds:.2f}s ({rate:.1f} chunks/s): "
+            f"{self.processed} cleaned, {self.cached} cached, {self.failed} failed and kept as extracted"
         )
-        embedding_models.append(embedding_model)
 
-    session.bulk_save_objects(embedding_models)
-    session.commit()
 
+def get_embedding(text: str, client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> np.ndarray:
+    return embed_texts([text], client, model, **kwargs)[0]
 
-def find_relevant_sections(user_id, query_embedding, user_preferences):
-    # Fetch the context window size
-    context_window_size = (
-        db.session.query(ModelContextWindow.context_window_size).filter_by(model_name=user_preferences.model).scalar()
-    )
 
-    max_sections = user_preferences.top_k
+def get_query_embedding(text: str, client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> np.ndarray:
+    """Embed a knowledge query, reusing the vector of an identical earlier query (e.g. a retried message)."""
+    key = QueryEmbeddingCache.make_key(text, model, kwargs.get("dimensions"))
+    vector = QueryEmbeddingCache.get(key)
+    if vector is None:
+        vector = QueryEmbeddingCache.put(key, get_embedding(normalize_query(text), client, model, **kwargs))
+    return vector
+
+
+def decode_embedding_data(data) -> np.ndarray:
+    """Turn one response embedding into float32, whether it came back base64-encoded or as a float list."""
+    if isinstance(data, str):
+        return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+    return np.asarray(data, dtype=np.float32)
+
+
+def embed_texts(texts: List[str], client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> np.ndarray:
+    """Embed several texts with one request, returning a float32 matrix with rows in input order.
+
+    Embeddings are requested base64-encoded and decoded straight into the matrix, skipping JSON float lists.
+    """
+    kwargs.setdefault("encoding_format", "base64")
+    response = client.embeddings.create(input=texts, model=model, **kwargs)
+    if len(response.data) != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings, but got {len(response.data)}")
+
+    expected_dimensions = kwargs.get("dimensions") or EMBEDDING_DIMENSIONS.get(model)
+    embeddings = None
+    for item in response.data:
+        embedding = decode_embedding_data(item.embedding)
+        if expected_dimensions and embedding.shape[0] != expected_dimensions:
+            raise ValueError(f"Expected embedding dimension to be {expected_dimensions}, but got {embedding.shape[0]}")
+        if embeddings is None:
+            embeddings = np.empty((len(texts), embedding.shape[0]), dtype=np.float32)
+        embeddings[item.index] = embedding
+    return embeddings
+
+
+class BatchPacker:
+    """Groups items into embedding requests under both the token and the input-count cap."""
+
+    def __init__(self, max_tokens: int = MAX_TOKENS_PER_BATCH, max_inputs: int = MAX_INPUTS_PER_BATCH):
+        self.max_tokens = max_tokens
+        self.max_inputs = max_inputs
+        self.items = []
+        self.tokens = 0
+
+    def add(self, item, tokens: int):
+        """Queue an item, returning the previous batch if the item did not fit in it."""
+        full = None
+        if self.items and (self.tokens + tokens > self.max_tokens or len(self.items) >= self.max_inputs):
+            full = self.flush()
+        self.items.append(item)
+        self.tokens += tokens
+        return full
+
+    def flush(self):
+        batch, self.items, self.tokens = self.items, [], 0
+        return batch or None
+
+
+def insert_rows(session, model, rows: list) -> None:
+    """Insert row dicts with Core executemany, INSERT_BATCH_ROWS at a time, in the session's transaction.
+
+    PyMySQL folds each executemany into multi-row INSERT statements, so thousands of rows take a few round trips.
+    """
+    table = model.__table__
+    for start in range(0, len(rows), INSERT_BATCH_ROWS):
+        session.execute(insert(table), rows[start:start + INSERT_BATCH_ROWS])
+
+
+def embedding_rows(chunk_ids: list, vectors: np.ndarray, user_id, storage_format: str,
+                   model: str = EMBEDDING_MODEL) -> list:
+    rows = []
+    for chunk_id, vector in zip(chunk_ids, vectors):
+        embedding_bytes, scale = encode_embedding(vector, storage_format)
+        rows.append({
+            "id": generate_uuid(),
+            "chunk_id": chunk_id,
+            "embedding": embedding_bytes,
+            "user_id": user_id,
+            "model": model,
+            "storage_format": storage_format,
+            "scale": scale,
+        })
+    return rows
+
+
+def select_within_budget(user_id, similarities, max_sections, token_budget):
+    """Take ranked (chunk_id, similarity) pairs in order until max_sections or the token budget is reached."""
+    tokens_by_id = VectorCache.chunk_tokens(user_id, [chunk_id for chunk_id, _ in similarities])
+
+    winners = []
+    current_tokens = 0
+    for chunk_id, similarity in similarities:
+        if len(winners) >= max_sections:
+            break
+        tokens = tokens_by_id.get(chunk_id)
+        if tokens is None:
+            continue
+        if current_tokens + tokens > token_budget:
+            break
+        winners.append((chunk_id, similarity))
+        current_tokens += tokens
+    return winners
+
 
-    # Fetch the document chunks and additional details for the user
-    document_chunks_with_details = (
+def fetch_chunk_details(winners):
+    """Load content and document details for the chosen chunks with one query, keeping their rank order."""
+    if not winners:
+        return []
+    rows = (
         db.session.query(
             DocumentChunk.id,
             Document.title,
             Document.author,
             DocumentChunk.pages,
-            DocumentChunk.content,  # Include the chunk content
+            DocumentChunk.content,
             DocumentChunk.tokens,
         )
         .join(Document)
-        .filter(Document.user_id == user_id, Document.selected == 1)
+        .filter(DocumentChunk.id.in_([chunk_id for chunk_id, _ in winners]))
         .all()
     )
+    chunks_by_id = {str(chunk.id): chunk for chunk in rows}
+    return [
+        (chunk.id, chunk.title, chunk.author, chunk.pages, chunk.content, chunk.tokens, similarity)
+        for chunk, similarity in ((chunks_by_id.get(chunk_id), similarity) for chunk_id, similarity in winners)
+        if chunk is not None
+    ]
 
-    # Get the IDs of the chunks for the current user's documents
-    subset_ids = [str(chunk.id) for chunk in document_chunks_with_details]
-
-    # Get a descending list of similarities for the subset using the MIPS naive method
-    similarities = VectorCache.mips_naive(query_embedding, subset_ids)
-
-    # Select chunks based on the max number of sections and token limit
-    selected_chunks = []
-    sections_appended = 0
-    current_tokens = 0
-
-    for chunk_id, similarity in similarities:
-        if sections_appended >= max_sections:
-            break
 
-        chunk = next((c for c in document_chunks_with_details if str(c.id) == chunk_id), None)
-        if chunk and current_tokens + chunk.tokens <= context_window_size:
-            selected_chunks.append(
-                (chunk.id, chunk.title, chunk.author, chunk.pages, chunk.content, chunk.tokens, similarity)
-            )
-            current_tokens += chunk.tokens
-            sections_appended += 1
-        elif chunk:
-            break
+def find_relevant_sections(user_id, query_embedding, user_preferences):
+    started = time.perf_counter()
+    # Fetch the context window size
+    context_window_size = (
+        db.session.query(ModelContextWindow.context_window_size).filter_by(model_name=user_preferences.model).scalar()
+    )
 
+    max_sections = user_preferences.top_k
+    prepared = time.perf_counter()
+
+    # Phase one ranks ids against cached vectors and token counts; only the winners' content leaves the database.
+    # The cache's selection mask follows Document.selected, as selection changes bump the user's vector version.
+    similarities = SearchBatcher.top_k(user_id, query_embedding, max_sections)
+    ranked = time.perf_counter()
+    winners = select_within_budget(user_id, similarities, max_sections, context_window_size)
+    budgeted = time.perf_counter()
+    selected_chunks = fetch_chunk_details(winners)
+    fetched = time.perf_counter()
+
+    logger.info(
+        f"Retrieval for user {user_id}: prepare {(prepared - started) * 1000:.1f} ms, "
+        f"rank {(ranked - prepared) * 1000:.1f} ms, budget {(budgeted - ranked) * 1000:.1f} ms, "
+        f"content {(fetched - budgeted) * 1000:.1f} ms, {len(selected_chunks)} chunks"
+    )
     return selected_chunks
 
 
@@ -215,9 +449,9 @@ def append_knowledge_context(user_query, user_id, client):
     if not user_preferences.knowledge_query_mode:
         return user_query
 
-    # Embed the user query
-    query_embedding = get_embedding(user_query, client)
-    query_vector = np.array(query_embedding, dtype=np.float32)
+    # Embed the user query with the model of the user's document vectors
+    model, dimensions = user_embedding_model(db.session, user_id)
+    query_vector = get_query_embedding(user_query, client, model, **embedding_kwargs(dimensions))
 
     # Find relevant sections
     relevant_sections = find_relevant_sections(user_id, query_vector, user_preferences)
@@ -229,7 +463,7 @@ def append_knowledge_context(user_query, user_id, client):
     # Format the context with title, author, and page number
     context = preface
     chunk_associations = []
-    for chunk_id, title, author, pages, chunk_content, tokens, similarity in relevant_sections:
+    for rank, (chunk_id, title, author, pages, chunk_content, tokens, similarity) in enumerate(relevant_sections, 1):
         context_parts = []
         if title:
             context_parts.append(f"Title: {title}")
@@ -241,7 +475,7 @@ def append_knowledge_context(user_query, user_id, client):
 
         context += "\n".join(context_parts) + "\n\n"
 
-        chunk_associations.append((chunk_id, similarity))
+        chunk_associations.append((chunk_id, rank))  # Stored as MessageChunkAssociation.similarity_rank
     modified_query = context + user_query
     return modified_query, chunk_associations
 
@@ -261,35 +495,92 @@ def delete_all_documents():
         db.session.rollback()
 
 
+PAGE_BREAK = re.compile(r"[.!?]+[\"')\]]*(?=\s)|\n[^\S\n]*\n")
+WORD = re.compile(r"\S+")
+
+
+def page_cut(buffer: str, start: int, end_of_file: bool, words_per_page: int = WORDS_PER_PAGE):
+    """Offset where the synthetic page starting at buffer[start] ends, or None when more text is needed to tell."""
+    word_ends = [match.end() for match in itertools.islice(WORD.finditer(buffer, start), 2 * words_per_page)]
+    if len(word_ends) < words_per_page:
+        return len(buffer) if end_of_file else None
+    # Past twice the page size, only search up to that word so cuts do not depend on how much has been read
+    search_end = word_ends[-1] if len(word_ends) == 2 * words_per_page else len(buffer)
+    page_break = PAGE_BREAK.search(buffer, word_ends[words_per_page - 1], search_end)
+    if page_break is not None:
+        return page_break.end()
+    if len(word_ends) == 2 * words_per_page:
+        return word_ends[words_per_page - 1]
+    return len(buffer) if end_of_file else None
+
+
 class TextExtractor:
-    def __init__(self, filepath):
+    def __init__(self, filepath, pdf_workers: int = None, pdf_parallel_min_pages: int = None):
         self.filepath = filepath
         self.last_page_number = None
+        # Read here because extraction usually runs on a pipeline thread without an app context
+        config = current_app.config if has_app_context() else {}
+        self.pdf_workers = pdf_workers if pdf_workers is not None else config.get("PDF_EXTRACTION_WORKERS", 0)
+        # Smaller PDFs are extracted in-process; the pool's overhead is not worth it
+        self.pdf_parallel_min_pages = (
+            pdf_parallel_min_pages if pdf_parallel_min_pages is not None else config.get("PDF_EXTRACTION_MIN_PAGES", 0)
+        )
 
-    def extract_text_from_pdf(self):
-        with open(self.filepath, "rb") as file:
-            reader = PdfReader(file)
-            for page_number, page in enumerate(reader.pages, start=1):
-                page_text = page.extract_text()
-                if page_text:
-                    yield (page_text, page_number)
-            self.last_page_number = page_number
+    def extract_text_from_pdf(self, first_page: int = 1, last_page: int = None):
+        page_count = self.count_pages()
+        last_page = min(last_page or page_count, page_count)
+        if self.pdf_workers > 1 and last_page - first_page + 1 >= self.pdf_parallel_min_pages:
+            pages = iter_pages_parallel(self.filepath, first_page, last_page, self.pdf_workers)
+        else:
+            pages = iter_page_range(self.filepath, first_page, last_page)
+        for page_text, page_number in pages:
+            if page_text:
+                yield (page_text, page_number)
+        self.last_page_number = last_page
+
+    def extract_text_from_txt(self, first_page: int = 1, last_page: int = None):
+        """Yield (text, page_number) for synthetic pages of WORDS_PER_PAGE words, read in buffered blocks.
+
+        A page runs to the first sentence end or blank line after its WORDS_PER_PAGE-th word, so sentences are
+        not cut at page edges; a run of twice that many words without one is cut after WORDS_PER_PAGE words.
+        Page numbers only depend on the file, so a range can be re-read when an interrupted task resumes.
+        """
+        first_page = first_page or 1
+        page_number = 0
+        buffer = ""
+        end_of_file = False
+        with open(self.filepath, "r", encoding="utf-8") as file:
+            while not end_of_file and (last_page is None or page_number < last_page):
+                block = file.read(TEXT_READ_BLOCK_SIZE)
+                end_of_file = not block
+                buffer += block
+                start = 0
+                while start < len(buffer) and (last_page is None or page_number < last_page):
+                    cut = page_cut(buffer, start, end_of_file)
+                    if cut is None:
+                        break
+                    page_text = buffer[start:cut].strip()
+                    start = cut
+                    if page_text:
+                        page_number += 1
+                        if page_number >= first_page:
+                            yield (page_text, page_number)
+                buffer = buffer[start:]
+        self.last_page_number = page_number
 
     def extract_text_from_code_file(self):
         with open(self.filepath, "r", encoding="utf-8") as file:
             code_text = file.read()
             yield (code_text, None)
 
-    def extract_text_from_file(self):
+    def extract_text_from_file(self, first_page: int = 1, last_page: int = None):
+        """Yield (text, page_number) pairs; the page range applies to PDFs and the synthetic pages of .txt files."""
         ext = os.path.splitext(self.filepath)[1].lower()
         if ext == ".pdf":
-            yield from self.extract_text_from_pdf()
+            yield from self.extract_text_from_pdf(first_page, last_page)
         elif ext == ".txt":
-            with open(self.filepath, "r", encoding="utf-8") as file:
-                for line_number, line in enumerate(file, start=1):
-                    yield (line.strip(), None)
-            self.last_page_number = line_number
-        elif ext in [".py", ".html", ".css", ".js", "md", "yml", "json"]:
+            yield from self.extract_text_from_txt(first_page, last_page)
+        elif ext in CODE_EXTENSIONS:
             yield from self.extract_text_from_code_file()
         else:
             raise ValueError(f"Unsupported file type: {ext}")
@@ -297,6 +588,13 @@ class TextExtractor:
     def get_final_page_amount(self):
         return self.last_page_number
 
+    def count_pages(self):
+        """Page count of a PDF, or None for file types that have no pages."""
+        if os.path.splitext(self.filepath)[1].lower() != ".pdf":
+            return None
+        with open(self.filepath, "rb") as file:
+            return len(PdfReader(file).pages)
+
 
 class TextSplitter:
     def __init__(self, max_tokens: int = 512, client=None, use_gpt_preprocessing=False, filepath=None):
@@ -306,6 +604,8 @@ class TextSplitter:
         self.temp_chunks = []
         self.use_gpt_preprocessing = use_gpt_preprocessing
         self.client = client
+        # Created here, in the app context, as chunks may be processed on a pipeline thread without one
+        self.preprocessor = ChunkPreprocessor(client) if use_gpt_preprocessing and client is not None else None
         self.chunks = []
         self.chunk_pages = []
         self.current_chunk = []
@@ -315,7 +615,7 @@ class TextSplitter:
 
     def add_text(self, text: str, page_number: int = None):
         ext = os.path.splitext(self.filepath)[1].lower()
-        if ext not in [".py", ".html", ".css", ".js", "md", "yml", "json"]:
+        if ext not in CODE_EXTENSIONS:
             text = preprocess_text(text)
         sentences = sent_tokenize(text)
 
@@ -371,34 +671,315 @@ class TextSplitter:
             self.current_chunk_pages = set()
 
     def _process_all_chunks(self):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            processed_chunks = list(executor.map(self._process_chunk, self.temp_chunks))
-        self.chunks.extend(processed_chunks)
+        self.chunks.extend(self.preprocessor.process(self.temp_chunks))
         self.temp_chunks = []
 
-    def _process_chunk(self, chunk):
-        if self.use_gpt_preprocessing and self.client is not None:
-            try:
-                response = gpt_preprocess(chunk, self.client)
-                return response.content
-            except Exception as e:
-                logger.error(f"An error occurred during preprocessing: {e}")
-                return None
-        else:
-            return chunk
-
-    def _process_batch(self, batch: List[str], client: openai.OpenAI) -> Generator[str, None, None]:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(gpt_preprocess, text, client) for text in batch]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    yield future.result().content
-                except Exception as e:
-                    logger.error(f"An error occurred during preprocessing: {e}")
-                    yield None
+    def add_pages(self, pages: List[Tuple[str, int]]):
+        for text, page_number in pages:
+            self.add_text(text, page_number)
+
+    def drain(self, final: bool = False, page_number: int = None) -> List[Tuple[str, Set[int], int]]:
+        """Hand over the chunks completed so far as (chunk, pages, tokens) triples, removing them from the splitter.
+
+        With final=True the chunk in progress is
+        completed first; pass the last page added so that chunk keeps its pages.
+        """
+        if final:
+            self._finalize_current_chunk(page_number, force_process=True)
+        ready = len(self.chunks)  # Pages are recorded before GPT-preprocessed chunks come back, so count chunks
+        drained = [
+            (chunk, pages, count_tokens(chunk)) for chunk, pages in zip(self.chunks, self.chunk_pages[:ready]) if chunk
+        ]
+        del self.chunks[:ready]
+        del self.chunk_pages[:ready]
+        return drained
 
     def finalize(self) -> Tuple[List[str], List[Set[int]], int, List[int]]:
         self._finalize_current_chunk(force_process=True)
         chunk_token_counts = [count_tokens(chunk) for chunk in self.chunks]
         total_tokens = sum(chunk_token_counts)
         return self.chunks, self.chunk_pages, total_tokens, chunk_token_counts
+
+
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*(?=\s)")
+
+
+def regex_sentence_ends(text: str) -> List[int]:
+    """Character offsets where sentences end: terminal punctuation (and closing quotes) followed by whitespace."""
+    return [match.end() for match in SENTENCE_END.finditer(text)]
+
+
+def utf8_offsets(text: str, offsets) -> np.ndarray:
+    """UTF-8 byte offsets of character offsets into text."""
+    if text.isascii():
+        return np.asarray(offsets, dtype=np.int64)
+    code_points = np.frombuffer(text.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+    char_lengths = 1 + (code_points >= 0x80) + (code_points >= 0x800) + (code_points >= 0x10000)
+    return np.concatenate(([0], np.cumsum(char_lengths)))[offsets]
+
+
+def nltk_sentence_ends(text: str) -> List[int]:
+    """Character offsets where the sentences found by NLTK sent_tokenize end."""
+    ends = []
+    position = 0
+    for sentence in sent_tokenize(text):
+        start = text.find(sentence, position)
+        if start >= 0:
+            position = start + len(sentence)
+            ends.append(position)
+    return ends
+
+
+class TokenTextSplitter(TextSplitter):
+    """TextSplitter that encodes every page once and builds chunks from slices of its token array.
+
+    add_pages encodes a batch of pages with one encode_ordinary_batch call. Sentence ends are mapped to token
+    offsets through a table of token byte lengths, so sentence and chunk sizes come from the page encoding instead
+    of encoding each sentence, word and finished chunk again; sentences longer than max_tokens are cut into
+    slices of at most max_tokens, at a word start where possible. Counts can differ from
+    encoding a chunk on its own by a token where a chunk joins two pages. GPT-preprocessed chunks are counted
+    after preprocessing, as their text changes.
+    """
+
+    _token_lengths = None  # Built on first use and shared by every instance
+    _token_starts_with_space = None
+
+    def __init__(self, max_tokens: int = 512, client=None, use_gpt_preprocessing=False, filepath=None,
+                 sentence_splitter: str = "nltk"):
+        super().__init__(max_tokens, client, use_gpt_preprocessing, filepath)
+        self.sentence_ends = regex_sentence_ends if sentence_splitter == "regex" else nltk_sentence_ends
+        self.chunk_token_counts = []  # Parallel to self.chunks; None where GPT preprocessing changed the text
+        self.current_segments = []  # [tokens, start, end] slices of encoded pages making up the current chunk
+
+    def _prepare(self, text: str) -> str:
+        ext = os.path.splitext(self.filepath)[1].lower()
+        if ext not in CODE_EXTENSIONS:
+            text = preprocess_text(text)
+        return text
+
+    def add_text(self, text: str, page_number: int = None):
+        self.add_pages([(text, page_number)])
+
+    def add_pages(self, pages: List[Tuple[str, int]]):
+        texts = [self._prepare(text) for text, _ in pages]
+        for text, tokens, (_, page_number) in zip(texts, ENCODING.encode_ordinary_batch(texts), pages):
+            self._add_tokens(text, tokens, page_number)
+
+    @classmethod
+    def _token_tables(cls):
+        """UTF-8 length of every token in the vocabulary, and whether it starts with whitespace."""
+        if cls._token_lengths is None:
+            lengths = np.zeros(ENCODING.n_vocab, dtype=np.int64)
+            starts_with_space = np.zeros(ENCODING.n_vocab, dtype=bool)
+            for token in range(ENCODING.n_vocab):
+                try:
+                    token_bytes = ENCODING.decode_single_token_bytes(token)
+                except KeyError:
+                    continue  # Unused ids between the ordinary and special tokens
+                lengths[token] = len(token_bytes)
+                starts_with_space[token] = token_bytes[:1].isspace()
+            cls._token_starts_with_space = starts_with_space
+            cls._token_lengths = lengths
+        return cls._token_lengths, cls._token_starts_with_space
+
+    def _add_tokens(self, text: str, tokens: List[int], page_number: int = None):
+        if not tokens:
+            return
+        lengths, starts_with_space = self._token_tables()
+        token_lengths = lengths[tokens]
+        token_starts = np.cumsum(token_lengths) - token_lengths  # UTF-8 offset of each token in the page
+        ends = utf8_offsets(text, self.sentence_ends(text))
+        boundaries = np.unique(np.append(np.searchsorted(token_starts, ends), len(tokens))).tolist()
+
+        start = 0
+        for end in boundaries:
+            if end <= start:
+                continue
+            sentence_token_count = end - start
+            if sentence_token_count > self.max_tokens:
+                self._finalize_current_chunk(page_number)
+                piece_start = start
+                while piece_start < end:
+                    piece_end = min(piece_start + self.max_tokens, end)
+                    if piece_end < end:
+                        piece_end = self._word_boundary(tokens, starts_with_space, piece_start, piece_end)
+                    self._add_segment(tokens, piece_start, piece_end, page_number)
+                    self._finalize_current_chunk(page_number)
+                    piece_start = piece_end
+            elif self.current_chunk_token_count + sentence_token_count <= self.max_tokens:
+                self._add_segment(tokens, start, end, page_number)
+            else:
+                self._finalize_current_chunk(page_number)
+                self._add_segment(tokens, start, end, page_number)
+            start = end
+
+    def _word_boundary(self, tokens: List[int], starts_with_space, start: int, end: int) -> int:
+        """Move a cut before token ``end`` back to the nearest token starting with whitespace, within half a chunk."""
+        cut = end
+        while cut > start + self.max_tokens // 2 and not starts_with_space[tokens[cut]]:
+            cut -= 1
+        return cut if starts_with_space[tokens[cut]] else end
+
+    def _add_segment(self, tokens: List[int], start: int, end: int, page_number: int = None):
+        last = self.current_segments[-1] if self.current_segments else None
+        if last is not None and last[0] is tokens and last[2] == start:
+            last[2] = end
+        else:
+            self.current_segments.append([tokens, start, end])
+        self.current_chunk_token_count += end - start
+        if page_number is not None:
+            self.current_chunk_pages.add(page_number)
+
+    def _finalize_current_chunk(self, page_number: int = None, force_process: bool = False):
+        if self.current_segments:
+            segments = (ENCODING.decode(tokens[start:end]).strip() for tokens, start, end in self.current_segments)
+            final_chunk = " ".join(segment for segment in segments if segment)
+            if self.use_gpt_preprocessing and self.client is not None:
+                self.temp_chunks.append(final_chunk)
+                if len(self.temp_chunks) >= self.batch_size or force_process:
+                    self._process_all_chunks()
+            else:
+                self.chunks.append(final_chunk)
+                self.chunk_token_counts.append(self.current_chunk_token_count)
+            self.chunk_pages.append(self.current_chunk_pages.copy() if page_number is not None else None)
+            self.current_segments = []
+            self.current_chunk_token_count = 0
+            self.current_chunk_pages = set()
+        elif force_process and self.temp_chunks:
+            self._process_all_chunks()
+
+    def _process_all_chunks(self):
+        processed = len(self.temp_chunks)
+        super()._process_all_chunks()
+        self.chunk_token_counts.extend([None] * processed)
+
+    def drain(self, final: bool = False, page_number: int = None) -> List[Tuple[str, Set[int], int]]:
+        if final:
+            self._finalize_current_chunk(page_number, force_process=True)
+        ready = len(self.chunks)
+        drained = [
+            (chunk, pages, tokens if tokens is not None else count_tokens(chunk))
+            for chunk, pages, tokens in zip(self.chunks, self.chunk_pages[:ready], self.chunk_token_counts)
+            if chunk
+        ]
+        del self.chunks[:ready]
+        del self.chunk_pages[:ready]
+        del self.chunk_token_counts[:ready]
+        return drained
+
+    def finalize(self) -> Tuple[List[str], List[Set[int]], int, List[int]]:
+        self._finalize_current_chunk(force_process=True)
+        chunk_token_counts = [
+            tokens if tokens is not None else count_tokens(chunk)
+            for chunk, tokens in zip(self.chunks, self.chunk_token_counts)
+        ]
+        return self.chunks, self.chunk_pages, sum(chunk_token_counts), chunk_token_counts
+
+
+CODE_BLOCK_STARTS = {  # Lines that open a top-level block: definitions, markdown headings, top-level keys
+    ".py": re.compile(r"(?:async\s+def|def|class)\b|@"),
+    ".js": re.compile(r"(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:function|class|const|let|var)\b"),
+    ".md": re.compile(r"#{1,6}(?:\s|$)"),
+    ".html": re.compile(r"\s*<(?:head|body|header|footer|main|nav|section|article|script|style|h[1-6])\b", re.I),
+    ".css": re.compile(r"[^\s}]"),
+    ".yml": re.compile(r"[^\s#-]"),
+}
+MARKDOWN_FENCE = re.compile(r"(?:```|~~~)")
+LINE_START = re.compile(r"^", re.M)
+
+
+class CodeTextSplitter:
+    """Splits code and markup files into chunks of whole top-level blocks, without NLTK.
+
+    Each file is encoded once. Chunks are packed greedily from the file's top-level blocks (definitions in
+    .py and .js, headings in .md, tags, rules and keys elsewhere); a block over max_tokens is split at blank
+    lines, then at line starts, and a single line over max_tokens is cut every max_tokens tokens. Chunk texts
+    are decoded from the file's token array and keep their indentation. Same interface as TokenTextSplitter.
+    """
+
+    def __init__(self, max_tokens: int = 512, filepath=None):
+        self.max_tokens = max_tokens
+        self.filepath = filepath
+        self.ext = os.path.splitext(filepath or "")[1].lower()
+        self.block_starts = CODE_BLOCK_STARTS.get(self.ext)
+        self.chunks = []  # (chunk, pages, tokens) ready to drain
+
+    def _line_levels(self, text: str) -> Tuple[List[int], List[int]]:
+        """Character offset of every line start, and where a split there ranks: 0 block, 1 blank line, 2 line."""
+        starts = [match.start() for match in LINE_START.finditer(text)]
+        lines = text.split("\n")
+        levels = []
+        previous_blank = False
+        previous_decorator = False
+        in_fence = False
+        for line in lines:
+            blank = not line.strip()
+            level = 2
+            if self.ext == ".md" and MARKDOWN_FENCE.match(line):
+                in_fence = not in_fence
+            elif not in_fence and self.block_starts is not None and not blank and self.block_starts.match(line):
+                level = 1 if previous_decorator else 0  # Keep a decorator with the definition it decorates
+            if level == 2 and previous_blank and not blank:
+                level = 1
+            levels.append(level)
+            previous_decorator = line.startswith("@")
+            previous_blank = blank
+        return starts, levels
+
+    def _pieces(self, cuts: List[int], ranks: List[int], start: int, end: int, level: int) -> list:
+        """Token ranges of at most max_tokens covering [start, end), split at cuts ranked this level or better."""
+        if end - start <= self.max_tokens:
+            return [(start, end)]
+        if level > 2:
+            return [(cut, min(cut + self.max_tokens, end)) for cut in range(start, end, self.max_tokens)]
+        first, last = bisect.bisect_right(cuts, start), bisect.bisect_left(cuts, end)
+        inner = [cuts[position] for position in range(first, last) if ranks[position] <= level]
+        pieces = []
+        for piece_start, piece_end in zip([start] + inner, inner + [end]):
+            pieces.extend(self._pieces(cuts, ranks, piece_start, piece_end, level + 1))
+        return pieces
+
+    def add_text(self, text: str, page_number: int = None):
+        tokens = ENCODING.encode_ordinary(text)
+        if not tokens:
+            return
+        lengths, _ = TokenTextSplitter._token_tables()
+        token_lengths = lengths[tokens]
+        token_starts = np.cumsum(token_lengths) - token_lengths
+        line_starts, levels = self._line_levels(text)
+        token_offsets = np.searchsorted(token_starts, utf8_offsets(text, line_starts)).tolist()
+        cuts, ranks = [], []  # Token index of each line start, and the best level of the lines starting there
+        for token, level in zip(token_offsets, levels):
+            if cuts and cuts[-1] == token:
+                ranks[-1] = min(ranks[-1], level)
+            elif 0 < token < len(tokens):
+                cuts.append(token)
+                ranks.append(level)
+
+        chunk_start = chunk_end = 0
+        for piece_start, piece_end in self._pieces(cuts, ranks, 0, len(tokens), 0):
+            if piece_end - chunk_start > self.max_tokens:
+                self._add_chunk(tokens, chunk_start, chunk_end, page_number)
+                chunk_start = piece_start
+            chunk_end = piece_end
+        self._add_chunk(tokens, chunk_start, chunk_end, page_number)
+
+    def _add_chunk(self, tokens: List[int], start: int, end: int, page_number: int = None):
+        chunk = ENCODING.decode(tokens[start:end]).rstrip().lstrip("\r\n")
+        if chunk:
+            self.chunks.append((chunk, {page_number} if page_number is not None else None, end - start))
+
+    def add_pages(self, pages: List[Tuple[str, int]]):
+        for text, page_number in pages:
+            self.add_text(text, page_number)
+
+    def drain(self, final: bool = False, page_number: int = None) -> List[Tuple[str, Set[int], int]]:
+        """Chunks never span two add_text calls, so every chunk added so far is complete."""
+        drained = self.chunks
+        self.chunks = []
+        return drained
+
+    def finalize(self) -> Tuple[List[str], List[Set[int]], int, List[int]]:
+        drained = self.drain(final=True)
+        token_counts = [tokens for _, _, tokens in drained]
+        return [chunk for chunk, _, _ in drained], [pages for _, pages, _ in drained], sum(token_counts), token_counts
@@ -0,0 +1,472 @@
+import concurrent.futures
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from flask import current_app
+
+from app.models.embedding_models import DocumentChunk, DocumentEmbedding
+from app.models.mixins import generate_uuid
+from app.modules.embedding.embedding_util import (
+    EMBEDDING_MODEL,
+    MAX_CONCURRENT_BATCHES,
+    BatchPacker,
+    count_tokens,
+    embed_texts,
+    embedding_kwargs,
+    embedding_model_name,
+    embedding_rows,
+    insert_rows,
+)
+from app.utils.chunk_embedding_cache import ChunkEmbeddingCache
+from app.utils.logging_util import configure_logging
+from app.utils.quantization import FLOAT32, decode_embedding, normalize
+from app.utils.vector_store import VectorStore
+
+logger = configure_logging()
+
+PAGE_QUEUE_SIZE = 16  # Extracted pages waiting to be split
+PAGE_BATCH_SIZE = PAGE_QUEUE_SIZE  # Most pages handed to the splitter at once
+CHUNK_QUEUE_SIZE = 16  # Drained groups of chunks waiting for GPT preprocessing
+PREPROCESS_AHEAD_PER_WORKER = 2  # Chunks submitted for preprocessing per pool worker, bounding a document's share
+BATCH_QUEUE_SIZE = MAX_CONCURRENT_BATCHES * 2  # Packed requests waiting for an embedding worker
+# Tokens per embedding request while streaming: a few pages' worth, so embedding starts while extraction goes on
+STREAM_BATCH_TOKENS = 8000
+QUEUE_POLL_SECONDS = 0.5  # How often blocked stages check whether another stage failed
+DEFAULT_CHECKPOINT_PAGES = 10
+_DONE = object()
+_FLUSH = object()  # Sent to the preprocess stage at a checkpoint boundary
+
+
+class _Stopped(Exception):
+    """Raised inside a stage when another stage has failed."""
+
+
+class ChunkBatch:
+    __slots__ = ("indices", "chunks", "pages", "token_counts", "vectors", "keys", "embedded")
+
+    def __init__(self, indices: list, chunks: list, pages: list, token_counts: list):
+        self.indices = indices  # chunk_index of each chunk
+        self.chunks = chunks
+        self.pages = pages
+        self.token_counts = token_counts
+        self.vectors = None
+        self.keys = None  # ChunkEmbeddingCache key of each chunk
+        self.embedded = None  # Positions of the chunks the API embedded; the rest came from the cache
+
+
+class IngestionResult:
+    __slots__ = ("chunk_count", "total_tokens", "vector_sum", "pages", "reused_chunks", "embedded_tokens")
+
+    def __init__(self, chunk_count: int, total_tokens: int, vector_sum, pages: int, reused_chunks: int = 0,
+                 embedded_tokens: int = None):
+        self.chunk_count = chunk_count
+        self.total_tokens = total_tokens
+        self.vector_sum = vector_sum  # Sum of the chunk vectors, None when nothing was embedded
+        self.pages = pages
+        self.reused_chunks = reused_chunks  # Chunks whose embedding was copied instead of requested
+        self.embedded_tokens = total_tokens if embedded_tokens is None else embedded_tokens  # Tokens billed
+
+    @property
+    def centroid(self):
+        """Unit-length mean of the chunk vectors, None for an empty document."""
+        return normalize(self.vector_sum) if self.vector_sum is not None else None
+
+
+def log_insert_rate(document_id: str, rows: int, seconds: float) -> None:
+    rate = rows / seconds if seconds > 0 else 0.0
+    logger.info(
+        f"Inserted {rows} chunk and embedding rows of document {document_id} in {seconds:.2f}s ({rate:.0f} rows/s)"
+    )
+
+
+class IngestionPipeline:
+    """Streams a document through extract -> split -> embed -> persist with bounded queues between stages.
+
+    Extraction, splitting and embedding run on their own threads (green threads under eventlet), so embedding
+    requests for early pages are in flight while later pages are still being parsed. Persisting stays on the
+    calling thread because it owns the database session. A failure in any stage stops the others and is
+    re-raised from run().
+
+    With on_checkpoint set, the chunk in progress is completed every ``checkpoint_pages`` pages so splitting can
+    restart at the next page, and on_checkpoint(chunk_index, page) is called once every chunk before that
+    boundary is committed. Chunk indexes in ``stored_indices`` are already in the database (from a run that was
+    interrupted after checkpointing) and are split again but not embedded.
+
+    With a ChunkPreprocessor, a preprocess stage between split and embed sends each new chunk through it and
+    packs the cleaned text, in chunk order, into embedding requests.
+    """
+
+    def __init__(self, session, document_id: str, user_id, text_pages, splitter, client, on_page=None,
+                 storage_format: str = None, start_index: int = 0, stored_indices=None, on_checkpoint=None,
+                 checkpoint_pages: int = None, preprocessor=None, model: str = EMBEDDING_MODEL,
+                 dimensions: int = None):
+        self.session = session
+        self.document_id = document_id
+        self.user_id = user_id
+        self.text_pages = text_pages  # Iterable of (text, page_number), e.g. TextExtractor.extract_text_from_file()
+        self.splitter = splitter
+        self.client = client
+        self.on_page = on_page  # Called from the split stage with each page number once it has been split
+        self.storage_format = storage_format or current_app.config.get("EMBEDDING_STORAGE_FORMAT", FLOAT32)
+        self.start_index = start_index  # chunk_index of the first chunk, for documents ingested in parts
+        self.stored_indices = set(stored_indices or ())
+        self.on_checkpoint = on_checkpoint
+        self.checkpoint_pages = checkpoint_pages or current_app.config.get(
+            "EMBEDDING_CHECKPOINT_PAGES", DEFAULT_CHECKPOINT_PAGES
+        )
+        self.engine = session.get_bind()  # Embedding workers look up cached chunks on their own connections
+        self.preprocessor = preprocessor
+        self.model = model
+        self.dimensions = dimensions
+        self.model_name = embedding_model_name(model, dimensions)  # Stored with each vector and in cache keys
+
+        self._pages = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+        self._chunks = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+        self._batches = queue.Queue(maxsize=BATCH_QUEUE_SIZE)
+        self._results = queue.Queue()
+        self._failed = threading.Event()
+        self._error = None
+        self._page_count = 0
+        self._inserted_rows = 0
+        self._insert_seconds = 0.0
+        self._boundaries = deque()  # (chunk_index, page) checkpoints reached by the split stage, in order
+        self._packer = BatchPacker(STREAM_BATCH_TOKENS)  # Used by the stage feeding the embedding workers only
+        self._pending = ChunkBatch([], [], [], [])
+
+    def _fail(self, error: BaseException) -> None:
+        if not self._failed.is_set():
+            self._error = error
+            self._failed.set()
+
+    def _put(self, target: queue.Queue, item) -> None:
+        while True:
+            if self._failed.is_set():
+                raise _Stopped()
+            try:
+                target.put(item, timeout=QUEUE_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source: queue.Queue):
+        while True:
+            if self._failed.is_set():
+                raise _Stopped()
+            try:
+                return source.get(timeout=QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                continue
+
+    def _result(self, future: concurrent.futures.Future):
+        while True:
+            if self._failed.is_set():
+                raise _Stopped()
+            try:
+                return future.result(timeout=QUEUE_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                continue
+
+    def _start(self, target) -> threading.Thread:
+        def run_stage():
+            try:
+                target()
+            except _Stopped:
+                pass
+            except BaseException as e:
+                self._fail(e)
+
+        thread = threading.Thread(target=run_stage, daemon=True)
+        thread.start()
+        return thread
+
+    def _extract(self) -> None:
+        for text, page_number in self.text_pages:
+            self._put(self._pages, (text, page_number))
+        self._put(self._pages, _DONE)
+
+    def _is_checkpoint(self, page_number) -> bool:
+        return self.on_checkpoint is not None and page_number is not None and page_number % self.checkpoint_pages == 0
+
+    def _pack(self, chunk_index: int, chunk: str, pages, tokens: int) -> None:
+        if self._packer.add(chunk, tokens):
+            self._put(self._batches, self._pending)
+            self._pending = ChunkBatch([], [], [], [])
+        self._pending.indices.append(chunk_index)
+        self._pending.chunks.append(chunk)
+        self._pending.pages.append(pages)
+        self._pending.token_counts.append(tokens)
+
+    def _flush_batch(self) -> None:
+        """Send the partly filled request, so every chunk packed so far gets embedded and committed."""
+        if self._pending.chunks:
+            self._put(self._batches, self._pending)
+            self._pending = ChunkBatch([], [], [], [])
+        self._packer.flush()
+
+    def _close_batches(self) -> None:
+        self._flush_batch()
+        for _ in range(MAX_CONCURRENT_BATCHES):
+            self._put(self._batches, _DONE)
+
+    def _split(self) -> None:
+        next_index = self.start_index
+        last_page = None
+
+        def queue_chunks(drained):
+            nonlocal next_index
+            new_chunks = []
+            for chunk, pages, tokens in drained:
+                if next_index not in self.stored_indices:
+                    new_chunks.append((next_index, chunk, pages, tokens))
+                next_index += 1
+            if self.preprocessor is None:
+                for new_chunk in new_chunks:
+                    self._pack(*new_chunk)
+            elif new_chunks:
+                self._put(self._chunks, new_chunks)
+
+        finished = False
+        while not finished:
+            # Split every page extraction has ready in one go, so the splitter can encode them as a batch
+            pages = [self._get(self._pages)]
+            while pages[-1] is not _DONE and len(pages) < PAGE_BATCH_SIZE and not self._is_checkpoint(pages[-1][1]):
+                try:
+                    pages.append(self._pages.get_nowait())
+                except queue.Empty:
+                    break
+            if pages[-1] is _DONE:
+                pages.pop()
+                finished = True
+            if not pages:
+                continue
+
+            self.splitter.add_pages(pages)
+            page_number = pages[-1][1]
+            if self._is_checkpoint(page_number):
+                queue_chunks(self.splitter.drain(final=True, page_number=page_number))
+                self._boundaries.append((next_index, page_number + 1))
+                # Don't leave the boundary's last chunks waiting for a full request
+                if self.preprocessor is None:
+                    self._flush_batch()
+                else:
+                    self._put(self._chunks, _FLUSH)
+            else:
+                queue_chunks(self.splitter.drain())
+            last_page = page_number
+            for _, page_number in pages:
+                self._page_count += 1
+                if self.on_page is not None:
+                    self.on_page(page_number if page_number is not None else self._page_count)
+
+        queue_chunks(self.splitter.drain(final=True, page_number=last_page))
+        if self.preprocessor is None:
+            self._close_batches()
+        else:
+            self._put(self._chunks, _DONE)
+
+    def _preprocess(self) -> None:
+        in_flight = deque()  # ((chunk_index, chunk, pages, tokens), future) in chunk order
+        limit = self.preprocessor.workers * PREPROCESS_AHEAD_PER_WORKER
+
+        def pack_next():
+            (chunk_index, chunk, pages, tokens), future = in_flight.popleft()
+            cleaned = self._result(future)
+            self._pack(chunk_index, cleaned, pages, tokens if cleaned == chunk else count_tokens(cleaned))
+
+        while True:
+            new_chunks = self._get(self._chunks)
+            if new_chunks is _DONE:
+                break
+            if new_chunks is _FLUSH:
+                while in_flight:
+                    pack_next()
+                self._flush_batch()
+                continue
+            in_flight.extend(zip(new_chunks, self.preprocessor.submit([chunk for _, chunk, _, _ in new_chunks])))
+            while in_flight and (len(in_flight) > limit or in_flight[0][1].done()):
+                pack_next()
+        while in_flight:
+            pack_next()
+        self._close_batches()
+
+    def _embed(self) -> None:
+        while True:
+            batch = self._get(self._batches)
+            if batch is _DONE:
+                self._results.put(_DONE)
+                return
+            batch.keys = [
+                ChunkEmbeddingCache.make_key(chunk, self.splitter.max_tokens, self.model_name) for chunk in batch.chunks
+            ]
+            cached = ChunkEmbeddingCache.lookup(self.engine, batch.keys)
+            batch.embedded = [position for position, key in enumerate(batch.keys) if key not in cached]
+            if batch.embedded:
+                texts = [batch.chunks[position].replace("\n", " ") for position in batch.embedded]
+                fresh = embed_texts(texts, self.client, self.model, **embedding_kwargs(self.dimensions))
+                cached.update(zip((batch.keys[position] for position in batch.embedded), fresh))
+            batch.vectors = np.stack([cached[key] for key in batch.keys])
+            self._results.put(batch)
+
+    def _persist(self, batch: ChunkBatch) -> None:
+        started = time.perf_counter()
+        chunk_ids = [generate_uuid() for _ in batch.chunks]
+        chunk_rows = [
+            {
+                "id": chunk_id,
+                "document_id": self.document_id,
+                "chunk_index": chunk_index,
+                "content": chunk,
+                "tokens": tokens,
+                "pages": ",".join(map(str, pages)) if pages is not None else None,
+            }
+            for chunk_id, chunk_index, chunk, pages, tokens in zip(
+                chunk_ids, batch.indices, batch.chunks, batch.pages, batch.token_counts
+            )
+        ]
+        # Chunks and their embeddings land in one transaction, so a checkpoint never covers half a batch
+        insert_rows(self.session, DocumentChunk, chunk_rows)
+        insert_rows(
+            self.session, DocumentEmbedding,
+            embedding_rows(chunk_ids, batch.vectors, self.user_id, self.storage_format, self.model_name),
+        )
+        self.session.commit()
+        self._inserted_rows += 2 * len(chunk_ids)
+        self._insert_seconds += time.perf_counter() - started
+        ChunkEmbeddingCache.remember(
+            self.session, [batch.keys[position] for position in batch.embedded], batch.vectors[batch.embedded],
+            self.model_name,
+        )
+
+        # VectorCache backfills the store from the database if this append fails
+        try:
+            VectorStore(self.user_id).append(
+                chunk_ids, [self.document_id] * len(chunk_ids), batch.vectors, self.model_name
+            )
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not append embeddings of document {self.document_id} to the vector store: {e}")
+
+    def _checkpoint(self, committed: set, committed_before: int) -> int:
+        """Advance past contiguously committed chunks and report the last checkpoint boundary they cover."""
+        while committed_before in committed or committed_before in self.stored_indices:
+            committed.discard(committed_before)
+            committed_before += 1
+        reached = None
+        while self._boundaries and self._boundaries[0][0] <= committed_before:
+            reached = self._boundaries.popleft()
+        if reached is not None:
+            self.on_checkpoint(*reached)
+        return committed_before
+
+    def run(self) -> IngestionResult:
+        threads = [self._start(self._extract), self._start(self._split)]
+        if self.preprocessor is not None:
+            threads.append(self._start(self._preprocess))
+        threads += [self._start(self._embed) for _ in range(MAX_CONCURRENT_BATCHES)]
+
+        chunk_count = 0
+        total_tokens = 0
+        embedded_chunks = 0
+        embedded_tokens = 0
+        vector_sum = None
+        finished_workers = 0
+        committed = set()  # Committed chunk indexes past committed_before; batches finish out of order
+        committed_before = self.start_index
+        try:
+            while finished_workers < MAX_CONCURRENT_BATCHES:
+                batch = self._get(self._results)
+                if batch is _DONE:
+                    finished_workers += 1
+                    continue
+                self._persist(batch)
+                if self.on_checkpoint is not None:
+                    committed.update(batch.indices)
+                    committed_before = self._checkpoint(committed, committed_before)
+                chunk_count += len(batch.chunks)
+                total_tokens += sum(batch.token_counts)
+                embedded_chunks += len(batch.embedded)
+                embedded_tokens += sum(batch.token_counts[position] for position in batch.embedded)
+                batch_sum = batch.vectors.sum(axis=0)
+                vector_sum = batch_sum if vector_sum is None else vector_sum + batch_sum
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+        if self._failed.is_set():
+            for thread in threads:
+                thread.join(timeout=QUEUE_POLL_SECONDS * 2)
+            raise self._error
+
+        reused_chunks = chunk_count - embedded_chunks
+        log_insert_rate(self.document_id, self._inserted_rows, self._insert_seconds)
+        if self.preprocessor is not None:
+            self.preprocessor.report(self.document_id)
+        logger.info(
+            f"Ingested {chunk_count} chunks ({total_tokens} tokens) of document {self.document_id}, "
+            f"{reused_chunks} embeddings reused"
+        )
+        return IngestionResult(chunk_count, total_tokens, vector_sum, self._page_count, reused_chunks, embedded_tokens)
+
+
+def copy_document_chunks(session, source_document_id: str, document_id: str, user_id) -> IngestionResult:
+    """Give document_id the chunks and embedding bytes of an identical, already ingested upload."""
+    rows = (
+        session.query(
+            DocumentChunk.chunk_index,
+            DocumentChunk.content,
+            DocumentChunk.tokens,
+            DocumentChunk.pages,
+            DocumentEmbedding.embedding,
+            DocumentEmbedding.model,
+            DocumentEmbedding.storage_format,
+            DocumentEmbedding.scale,
+        )
+        .join(DocumentEmbedding, DocumentEmbedding.chunk_id == DocumentChunk.id)
+        .filter(DocumentChunk.document_id == source_document_id)
+        .order_by(DocumentChunk.chunk_index)
+        .all()
+    )
+    started = time.perf_counter()
+    chunk_ids = [generate_uuid() for _ in rows]
+    chunk_rows = []
+    copied_embedding_rows = []
+    vectors = []
+    for chunk_id, row in zip(chunk_ids, rows):
+        chunk_rows.append({
+            "id": chunk_id,
+            "document_id": document_id,
+            "chunk_index": row.chunk_index,
+            "content": row.content,
+            "tokens": row.tokens,
+            "pages": row.pages,
+        })
+        copied_embedding_rows.append({
+            "id": generate_uuid(),
+            "chunk_id": chunk_id,
+            "embedding": row.embedding,
+            "user_id": user_id,
+            "model": row.model,
+            "storage_format": row.storage_format,
+            "scale": row.scale,
+        })
+        vectors.append(decode_embedding(row.embedding, row.storage_format, row.scale))
+    insert_rows(session, DocumentChunk, chunk_rows)
+    insert_rows(session, DocumentEmbedding, copied_embedding_rows)
+    session.commit()
+    log_insert_rate(document_id, 2 * len(chunk_rows), time.perf_counter() - started)
+
+    if vectors:
+        try:
+            VectorStore(user_id).append(chunk_ids, [document_id] * len(chunk_ids), np.stack(vectors), rows[0].model)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not append embeddings of document {document_id} to the vector store: {e}")
+
+    total_tokens = sum(row["tokens"] for row in chunk_rows)
+    logger.info(f"Copied {len(rows)} chunks of document {source_document_id} into document {document_id}")
+    return IngestionResult(
+        len(rows), total_tokens, np.sum(vectors, axis=0) if vectors else None, 0, reused_chunks=len(rows),
+        embedded_tokens=0,
+    )
@@ -9,6 +9,7 @@ from app.modules.user.user_util import get_user_audio_directory
 from app.tasks.celery_task import celery
 from app.utils.logging_util import configure_logging
 from app.utils.task_util import make_session
+from app.utils.vector_store import iter_user_stores
 
 logger = configure_logging()
 
@@ -28,7 +29,13 @@ def cleanup_documents():
         for document in all_documents:
             document_task_id = document.task_id
             embedding_task = session.query(EmbeddingTask).filter_by(task_id=document_task_id).first()
-            if embedding_task and os.path.exists(embedding_task.temp_path):
+            # A checkpointed or fanned-out task still needs its upload, unless it has been stuck for a day
+            in_progress = (
+                embedding_task is not None and not document.delete
+                and (embedding_task.resume_page is not None or embedding_task.parts_pending is not None)
+                and document.created_at >= now - timedelta(hours=24)
+            )
+            if embedding_task and not in_progress and os.path.exists(embedding_task.temp_path):
                 os.remove(embedding_task.temp_path)
                 logger.info(f"Removed file at {embedding_task.temp_path}")
 
@@ -140,3 +147,27 @@ def cleanup_translation():
         return False
     finally:
         session.remove()  # Dispose of the session correctly
+
+
+@celery.task()
+def compact_vector_stores():
+    session = make_session()
+    try:
+        for store in iter_user_stores():
+            def live_documents(user_id=store.user_id):
+                # Documents are committed before their first append, so reading them under the store lock is safe
+                return {
+                    document_id
+                    for document_id, in session.query(Document.id).filter(
+                        Document.user_id == user_id, Document.delete == False
+                    )
+                }
+
+            removed = store.compact(live_documents)
+            if removed:
+                logger.info(f"Compacted {removed} vectors out of the vector store of user {store.user_id}")
+    except Exception as e:
+        logger.error(f"Error compacting vector stores: {e}")
+        return False
+    finally:
+        session.remove()  # Dispose of the session correctly
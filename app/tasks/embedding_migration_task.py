@@ -0,0 +1,312 @@
+from datetime import datetime
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from app.models.embedding_models import (
+    Document,
+    DocumentChunk,
+    DocumentEmbedding,
+    EmbeddingMigration,
+    ShadowEmbedding,
+)
+from app.models.user_models import User
+from app.modules.auth.auth_util import task_client
+from app.modules.embedding.embedding_util import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    BatchPacker,
+    embed_texts,
+    embedding_kwargs,
+    embedding_model_name,
+    insert_rows,
+    user_embedding_model,
+)
+from app.tasks.celery_task import celery
+from app.tasks.embedding_task import RETRY_DELAY, RETRYABLE_ERRORS, build_vector_index_task
+from app.utils.ann_index import IVFIndex
+from app.utils.logging_util import configure_logging
+from app.utils.quantization import FLOAT32, decode_embedding, encode_embedding, normalize
+from app.utils.task_util import make_session
+from app.utils.usage_util import embedding_cost
+from app.utils.vector_cache import VectorCache
+from app.utils.vector_store import VectorStore
+
+logger = configure_logging()
+
+ACTIVE_STATUSES = ("pending", "running")
+SWEEP_DELAY = 900  # Seconds after a flip to look for chunks an upload in flight stored under the old model
+
+
+def start_embedding_migration(session, model: str, dimensions: int = None, user_id=None) -> list:
+    """Create migrations moving one user, or every user, to model at dimensions, returning their ids.
+
+    Users already on that model get none. Unfinished migrations of the same users are cancelled, and their
+    shadow embeddings of other models are dropped.
+    """
+    if model not in EMBEDDING_DIMENSIONS:
+        raise ValueError(f"Unknown embedding model: {model}")
+    target = embedding_model_name(model, dimensions)
+    dimensions = dimensions if target != model else None
+
+    users = session.query(User.id, User.embedding_model, User.embedding_dimensions).filter(User.delete == False)
+    if user_id is not None:
+        users = users.filter(User.id == str(user_id))
+    migration_ids = []
+    for user_id, user_model, user_dimensions in users.all():
+        session.query(EmbeddingMigration).filter(
+            EmbeddingMigration.user_id == user_id, EmbeddingMigration.status.in_(ACTIVE_STATUSES)
+        ).update({EmbeddingMigration.status: "cancelled"}, synchronize_session=False)
+        session.query(ShadowEmbedding).filter(
+            ShadowEmbedding.user_id == user_id, ShadowEmbedding.model != target
+        ).delete(synchronize_session=False)
+        if embedding_model_name(user_model or EMBEDDING_MODEL, user_dimensions) == target:
+            continue
+        migration = EmbeddingMigration(user_id=user_id, model=model, dimensions=dimensions)
+        session.add(migration)
+        session.flush()
+        migration_ids.append(migration.id)
+    session.commit()
+    return migration_ids
+
+
+def pending_chunks(session, user_id: str, target: str, limit: int) -> list:
+    """(chunk_id, content, tokens) of live chunks stored under another model that have no shadow embedding yet."""
+    shadowed = (
+        session.query(ShadowEmbedding.chunk_id)
+        .filter(ShadowEmbedding.chunk_id == DocumentEmbedding.chunk_id, ShadowEmbedding.model == target)
+        .exists()
+    )
+    return (
+        session.query(DocumentEmbedding.chunk_id, DocumentChunk.content, DocumentChunk.tokens)
+        .join(DocumentChunk, DocumentChunk.id == DocumentEmbedding.chunk_id)
+        .join(Document, Document.id == DocumentChunk.document_id)
+        .filter(
+            DocumentEmbedding.user_id == user_id,
+            DocumentEmbedding.model != target,
+            Document.delete == False,
+            ~shadowed,
+        )
+        .limit(limit)
+        .all()
+    )
+
+
+def embed_shadow_batch(session, migration, target: str, chunks: list, client) -> int:
+    """Embed the chunks under the migration's model into shadow_embeddings, returning the tokens embedded."""
+    storage_format = current_app.config.get("EMBEDDING_STORAGE_FORMAT", FLOAT32)
+    packer = BatchPacker()
+    requests = []
+    for chunk in chunks:
+        full = packer.add(chunk, chunk.tokens)
+        if full:
+            requests.append(full)
+    last = packer.flush()
+    if last:
+        requests.append(last)
+
+    rows = []
+    for request in requests:
+        vectors = embed_texts(
+            [chunk.content.replace("\n", " ") for chunk in request], client, migration.model,
+            **embedding_kwargs(migration.dimensions),
+        )
+        for chunk, vector in zip(request, vectors):
+            embedding_bytes, scale = encode_embedding(vector, storage_format)
+            rows.append({
+                "chunk_id": chunk.chunk_id,
+                "model": target,
+                "user_id": migration.user_id,
+                "embedding": embedding_bytes,
+                "storage_format": storage_format,
+                "scale": scale,
+            })
+    insert_rows(session, ShadowEmbedding, rows)
+    tokens = sum(chunk.tokens for chunk in chunks)
+    migration.embedded_chunks += len(rows)
+    migration.embedded_tokens += tokens
+    session.commit()
+    return tokens
+
+
+def flip_embeddings(session, migration_id: str, target: str) -> bool:
+    """Swap the shadow embeddings in and move the user's queries to the new model, in one transaction."""
+    migration = session.query(EmbeddingMigration).filter_by(id=migration_id).with_for_update().one()
+    if migration.status not in ACTIVE_STATUSES + ("completed",):
+        session.rollback()  # Cancelled while the last batch was embedded
+        return False
+    user_id = migration.user_id
+    embeddings = DocumentEmbedding.__table__
+    shadow = ShadowEmbedding.__table__
+    session.execute(
+        update(embeddings)
+        .where(embeddings.c.chunk_id == shadow.c.chunk_id, shadow.c.model == target, shadow.c.user_id == user_id)
+        .values(
+            embedding=shadow.c.embedding, storage_format=shadow.c.storage_format, scale=shadow.c.scale, model=target
+        )
+    )
+    session.query(ShadowEmbedding).filter(
+        ShadowEmbedding.user_id == user_id, ShadowEmbedding.model == target
+    ).delete(synchronize_session=False)
+    # Centroids of the old vectors would misroute; VectorCache averages the new ones until they are stored again
+    session.query(Document).filter(Document.user_id == user_id).update(
+        {Document.centroid: None}, synchronize_session=False
+    )
+    session.query(User).filter(User.id == user_id).update(
+        {User.embedding_model: migration.model, User.embedding_dimensions: migration.dimensions},
+        synchronize_session=False,
+    )
+    VectorCache.bump_version(session, user_id)
+    migration.status = "completed"
+    migration.completed_at = datetime.utcnow()
+    session.commit()
+    return True
+
+
+def rebuild_vector_store(session, user_id: str, target: str, dimensions: int) -> None:
+    """Rewrite the user's vector store and document centroids from their embeddings under the new model.
+
+    Until the store is rewritten VectorCache reads the user's vectors from the database, as the store's model
+    no longer matches theirs.
+    """
+    rows = (
+        session.query(
+            DocumentEmbedding.chunk_id,
+            DocumentChunk.document_id,
+            DocumentEmbedding.embedding,
+            DocumentEmbedding.storage_format,
+            DocumentEmbedding.scale,
+        )
+        .join(DocumentChunk, DocumentChunk.id == DocumentEmbedding.chunk_id)
+        .join(Document, Document.id == DocumentChunk.document_id)
+        .filter(DocumentEmbedding.user_id == user_id, DocumentEmbedding.model == target, Document.delete == False)
+        .order_by(DocumentChunk.document_id, DocumentChunk.chunk_index)
+        .all()
+    )
+    if rows:
+        vectors = np.stack([decode_embedding(row.embedding, row.storage_format, row.scale) for row in rows])
+    else:
+        vectors = np.empty((0, dimensions), dtype=np.float32)
+    document_ids = [row.document_id for row in rows]
+
+    store = VectorStore(user_id)
+    IVFIndex.remove(store.directory)  # Trained on the old vectors; rebuilt below
+    store.rewrite([str(row.chunk_id) for row in rows], document_ids, vectors, target)
+
+    if not rows:
+        return
+    codes, starts = np.unique(document_ids, return_index=True)
+    sums = np.add.reduceat(vectors, starts, axis=0)  # Rows are grouped by document
+    for document_id, centroid in zip(codes.tolist(), normalize(sums)):
+        session.query(Document).filter(Document.id == document_id).update(
+            {Document.centroid: centroid.tobytes()}, synchronize_session=False
+        )
+    session.commit()
+
+
+def fail_migration(session, migration_id: str, error: Exception) -> None:
+    session.rollback()
+    session.query(EmbeddingMigration).filter_by(id=migration_id).update(
+        {EmbeddingMigration.status: "failed", EmbeddingMigration.error: str(error)}, synchronize_session=False
+    )
+    session.commit()
+
+
+@celery.task()
+def start_embedding_migration_task(model, dimensions=None, user_id=None):
+    """Re-embed one user's chunks, or every user's, under model at dimensions (None for the native size).
+
+    Each migration embeds batches of the user's chunks into shadow_embeddings, spaced by
+    EMBEDDING_MIGRATION_BATCH_DELAY so the user's own uploads and chats keep their rate limit headroom.
+    Retrieval keeps using the old vectors and query model meanwhile. Once every chunk has a shadow embedding,
+    one transaction copies them into document_embeddings and switches the user's query model.
+    """
+    session = make_session()
+    try:
+        migration_ids = start_embedding_migration(session, model, dimensions, user_id)
+        for migration_id in migration_ids:
+            migrate_embeddings_task.apply_async(kwargs={"migration_id": migration_id})
+        logger.info(f"Started {len(migration_ids)} migrations to {embedding_model_name(model, dimensions)}")
+        return migration_ids
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Could not start a migration to {model}: {e}")
+        return []
+    finally:
+        session.remove()
+
+
+@celery.task(bind=True, time_limit=200, soft_time_limit=180, max_retries=5, acks_late=True)
+def migrate_embeddings_task(self, migration_id, sweep=False):
+    """Embed one batch of a migration and schedule the next, or flip the migration once nothing is left.
+
+    With sweep=True, run some time after a flip to catch chunks an upload in flight during the flip stored
+    under the old model; they get the same shadow-and-flip treatment.
+    """
+    session = make_session()
+    try:
+        migration = session.query(EmbeddingMigration).filter_by(id=migration_id).one_or_none()
+        if migration is None or migration.status in ("failed", "cancelled"):
+            return False
+        if migration.status == "completed" and not sweep:
+            return True
+        user_id = migration.user_id
+        target = embedding_model_name(migration.model, migration.dimensions)
+        if sweep and embedding_model_name(*user_embedding_model(session, user_id)) != target:
+            return True  # Another migration has moved the user on since
+
+        chunks = pending_chunks(session, user_id, target, current_app.config["EMBEDDING_MIGRATION_BATCH_CHUNKS"])
+        if not chunks:
+            if sweep and migration.status == "completed":
+                return True
+            if flip_embeddings(session, migration_id, target):
+                logger.info(
+                    f"Migrated {migration.embedded_chunks} embeddings of user {user_id} to {target} "
+                    f"({migration.embedded_tokens} tokens)"
+                )
+                try:
+                    rebuild_vector_store(
+                        session, user_id, target, migration.dimensions or EMBEDDING_DIMENSIONS[migration.model]
+                    )
+                except (OSError, ValueError) as e:
+                    session.rollback()
+                    logger.error(f"Could not rebuild the vector store of user {user_id} after migrating: {e}")
+                build_vector_index_task.apply_async(kwargs={"user_id": user_id})
+                migrate_embeddings_task.apply_async(
+                    kwargs={"migration_id": migration_id, "sweep": True}, countdown=SWEEP_DELAY
+                )
+            return True
+
+        migration.status = "running"
+        session.commit()
+        client, key_id, error = task_client(session, user_id)
+        if error:
+            raise Exception(error)
+        try:
+            tokens = embed_shadow_batch(session, migration, target, chunks, client)
+            embedding_cost(session=session, user_id=user_id, api_key_id=key_id, input_tokens=tokens)
+        except IntegrityError as e:
+            # A chunk was deleted, or a redelivered copy of this task stored it first; the next batch skips it
+            session.rollback()
+            logger.info(f"Skipping a batch of migration {migration_id}: {e}")
+        migrate_embeddings_task.apply_async(
+            kwargs={"migration_id": migration_id, "sweep": sweep},
+            countdown=current_app.config["EMBEDDING_MIGRATION_BATCH_DELAY"],
+        )
+        return True
+    except RETRYABLE_ERRORS as e:
+        session.rollback()
+        if self.request.retries < self.max_retries:
+            logger.info(f"Retrying migration {migration_id}: {e}")
+            raise self.retry(exc=e, countdown=RETRY_DELAY * 2 ** self.request.retries)
+        logger.error(f"Migration {migration_id} failed: {e}")
+        fail_migration(session, migration_id, e)
+        return False
+    except Exception as e:
+        logger.error(f"Migration {migration_id} failed: {e}")
+        fail_migration(session, migration_id, e)
+        return False
+    finally:
+        session.remove()
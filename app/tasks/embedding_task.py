@@ -1,22 +1,224 @@
 import os
-from app.models.embedding_models import Document, DocumentChunk
+
+import numpy as np
+import openai
+from celery import chord, group
+from celery.exceptions import SoftTimeLimitExceeded
+from flask import current_app
+
+from app.models.embedding_models import Document, DocumentChunk, DocumentEmbedding
 from app.models.task_models import Task, EmbeddingTask
 from app.modules.auth.auth_util import task_client
 from app.modules.embedding.embedding_util import (
-    get_embedding_batch,
-    store_embeddings, TextSplitter, TextExtractor, extract_uuid_from_path,
+    CODE_EXTENSIONS,
+    ChunkPreprocessor,
+    CodeTextSplitter,
+    TokenTextSplitter,
+    TextExtractor,
+    embedding_model_name,
+    extract_uuid_from_path,
+    user_embedding_model,
 )
+from app.modules.embedding.ingestion_pipeline import IngestionPipeline, copy_document_chunks
+from app.utils.chunk_embedding_cache import ChunkEmbeddingCache
 from app.utils.logging_util import configure_logging
+from app.utils.quantization import decode_embedding, normalize
 from app.utils.task_util import make_session
 from app.utils.usage_util import embedding_cost
+from app.utils.vector_cache import VectorCache
+from app.utils.vector_store import VectorStore
 from app import socketio
 from app.tasks.celery_task import celery
 
 logger = configure_logging()
 
+# Failures worth retrying from the last checkpoint instead of discarding the document
+RETRYABLE_ERRORS = (
+    SoftTimeLimitExceeded,
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+RETRY_DELAY = 30  # Seconds before the first retry, doubled on each further retry
+
+
+def emit_page_progress(embedding_task, user_id, page_number):
+    socketio.emit(
+        "task_progress",
+        {
+            "task_id": embedding_task.task_id,
+            "message": f"Processing page {page_number} of {embedding_task.title}...",
+            "page": page_number,
+        },
+        room=str(user_id),
+        namespace="/embedding",
+    )
+
+
+def create_document(session, embedding_task, user_id):
+    # The document row comes first so chunks can be committed as soon as their batch is embedded
+    new_document = Document(
+        id=extract_uuid_from_path(embedding_task.temp_path),
+        user_id=user_id,
+        task_id=embedding_task.task_id,
+        title=embedding_task.title,
+        author=embedding_task.author,
+        total_tokens=0,
+        file_hash=embedding_task.file_hash,
+    )
+    session.add(new_document)
+    embedding_task.document_id = new_document.id
+    session.commit()
+    return new_document
+
+
+def find_ingested_copy(session, embedding_task, user_id):
+    """A finished document from an identical upload, split with the same settings and embedded with the user's model.
+
+    Returns None when there is none.
+    """
+    if not embedding_task.file_hash or not ChunkEmbeddingCache.enabled:
+        return None
+    model_name = embedding_model_name(*user_embedding_model(session, user_id))
+    same_model = (
+        session.query(DocumentChunk.id)
+        .join(DocumentEmbedding, DocumentEmbedding.chunk_id == DocumentChunk.id)
+        .filter(DocumentChunk.document_id == Document.id, DocumentEmbedding.model == model_name)
+        .exists()
+    )
+    return (
+        session.query(Document)
+        .join(EmbeddingTask, EmbeddingTask.task_id == Document.task_id)
+        .filter(
+            Document.file_hash == embedding_task.file_hash,
+            Document.delete == False,
+            Document.total_tokens > 0,
+            EmbeddingTask.chunk_size == embedding_task.chunk_size,
+            EmbeddingTask.advanced_preprocessing == embedding_task.advanced_preprocessing,
+            EmbeddingTask.resume_page.is_(None),
+            same_model,
+        )
+        .order_by(Document.created_at.desc())
+        .first()
+    )
+
+
+def stored_chunks(session, document_id):
+    """Chunk indexes, token total and vector sum of the chunks an interrupted run already committed."""
+    indices = []
+    total_tokens = 0
+    vector_sum = None
+    rows = (
+        session.query(
+            DocumentChunk.chunk_index,
+            DocumentChunk.tokens,
+            DocumentEmbedding.embedding,
+            DocumentEmbedding.storage_format,
+            DocumentEmbedding.scale,
+        )
+        .join(DocumentEmbedding, DocumentEmbedding.chunk_id == DocumentChunk.id)
+        .filter(DocumentChunk.document_id == document_id)
+    )
+    for chunk_index, tokens, embedding, storage_format, scale in rows:
+        indices.append(chunk_index)
+        total_tokens += tokens or 0
+        vector = decode_embedding(embedding, storage_format, scale)
+        vector_sum = vector if vector_sum is None else vector_sum + vector
+    return indices, total_tokens, vector_sum
+
 
-def process_document(session, embedding_task, user_id):
+def run_pipeline(session, embedding_task, user_id, document_id, text_pages, client, start_index=0, stored_indices=None,
+                 on_checkpoint=None):
+    if os.path.splitext(embedding_task.temp_path)[1].lower() in CODE_EXTENSIONS:
+        text_splitter = CodeTextSplitter(max_tokens=embedding_task.chunk_size, filepath=embedding_task.temp_path)
+    else:
+        text_splitter = TokenTextSplitter(
+            max_tokens=embedding_task.chunk_size,
+            filepath=embedding_task.temp_path,
+            sentence_splitter=current_app.config["EMBEDDING_SENTENCE_SPLITTER"],
+        )
+    # Chunks are preprocessed by the pipeline as they are split, instead of by the splitter in blocking batches
+    preprocessor = ChunkPreprocessor(client, session.get_bind()) if embedding_task.advanced_preprocessing else None
+    model, dimensions = user_embedding_model(session, user_id)
+    logger.info(f"Splitting text into chunks of {embedding_task.chunk_size} tokens")
+    pipeline = IngestionPipeline(
+        session, document_id, user_id, text_pages, text_splitter, client,
+        on_page=lambda page_number: emit_page_progress(embedding_task, user_id, page_number),
+        start_index=start_index,
+        stored_indices=stored_indices,
+        on_checkpoint=on_checkpoint,
+        preprocessor=preprocessor,
+        model=model,
+        dimensions=dimensions,
+    )
+    return pipeline.run()
+
+
+def finish_document(session, embedding_task, user_id, document, key_id, chunk_count, total_tokens, centroid,
+                    page_amount, embedded_tokens=None, reused_chunks=0):
+    document.total_tokens = total_tokens
+    if centroid is not None:
+        document.centroid = centroid.tobytes()
+    embedding_task.resume_page = None
+    embedding_task.parts_pending = None
+    VectorCache.bump_version(session, user_id)
+    session.commit()
+    socketio.emit(
+        "task_progress",
+        {"task_id": embedding_task.task_id, "message": f"Calculating cost of {embedding_task.title}..."},
+        room=str(user_id),
+        namespace="/embedding",
+    )
+    # Chunks whose embeddings were reused cost nothing
+    embedded_tokens = total_tokens if embedded_tokens is None else embedded_tokens
+    embedding_cost(session=session, user_id=user_id, api_key_id=key_id, input_tokens=embedded_tokens)
+    logger.info(
+        f"Document {document.id}: reused {reused_chunks} of {chunk_count} embeddings, billed {embedded_tokens} of "
+        f"{total_tokens} tokens; cache stats {ChunkEmbeddingCache.stats()}"
+    )
+    socketio.emit(
+        "task_complete",
+        {
+            "task_id": embedding_task.task_id,
+            "message": f"Embedding task for {embedding_task.title} has completed.",
+            "status": "completed",
+            "document": {
+                "title": embedding_task.title,
+                "author": embedding_task.author,
+                "chunk_count": chunk_count,
+                "document_id": document.id,
+                "page_amount": page_amount,
+                "total_tokens": total_tokens,
+                "reused_chunks": reused_chunks,
+            },
+        },
+        room=str(user_id),
+        namespace="/embedding",
+    )
+    build_vector_index_task.apply_async(kwargs={"user_id": user_id})
+
+
+def discard_document(session, user_id, document_id):
+    # Batches committed before the failure stay hidden until the deletion task removes them
+    session.rollback()
+    session.query(Document).filter_by(id=document_id).update({"delete": True})
+    session.query(EmbeddingTask).filter_by(document_id=document_id).update(
+        {"resume_page": None, "parts_pending": None}
+    )
+    VectorCache.bump_version(session, user_id)
+    session.commit()
+    VectorStore(user_id).add_tombstones([document_id])
+
+
+def process_document(session, embedding_task, user_id, can_retry=False):
+    new_document = None
     try:
+        if embedding_task.resume_page is not None:
+            new_document = session.query(Document).filter_by(id=embedding_task.document_id, delete=False).one()
+            logger.info(
+                f"Resuming document {embedding_task.id} at page {embedding_task.resume_page}, "
+                f"chunk {embedding_task.resume_chunk_index}"
+            )
         socketio.emit(
             "task_progress",
             {"task_id": embedding_task.task_id, "message": f"Extracting text from {embedding_task.title}..."},
@@ -25,92 +227,59 @@ def process_document(session, embedding_task, user_id):
         )
         logger.info(f"Processing document {embedding_task.id}: {embedding_task.title}")
 
-        extractor = TextExtractor(embedding_task.temp_path)
-        text_pages = extractor.extract_text_from_file()
-
         client, key_id, error = task_client(session, user_id)
         if error:
             raise Exception(error)
-        text_splitter = TextSplitter(max_tokens=embedding_task.chunk_size, client=client, use_gpt_preprocessing=embedding_task.advanced_preprocessing, filepath=embedding_task.temp_path)
-        logger.info(f"Splitting text into chunks of {embedding_task.chunk_size} tokens")
-        for text, page_number in text_pages:
-            text_splitter.add_text(text, page_number)
-
-        # Finalize text splitting and get results
-        chunks, chunk_pages, total_tokens, chunk_token_counts = text_splitter.finalize()
-        file_uuid = extract_uuid_from_path(embedding_task.temp_path)
-
-        new_document = Document(
-            id=file_uuid,
-            user_id=user_id,
-            task_id=embedding_task.task_id,
-            title=embedding_task.title,
-            author=embedding_task.author,
-            total_tokens=total_tokens,
-        )
-        session.add(new_document)
-        session.flush()
+        if new_document is None:
+            embedding_task.resume_page = 1
+            embedding_task.resume_chunk_index = 0
+            new_document = create_document(session, embedding_task, user_id)
+            stored_indices, stored_tokens, stored_sum = [], 0, None
+        else:
+            stored_indices, stored_tokens, stored_sum = stored_chunks(session, new_document.id)
 
-        # Emit progress update for processing document chunks
-        socketio.emit(
-            "task_progress",
-            {"task_id": embedding_task.task_id, "message": f"Processing document chunks for {embedding_task.title}..."},
-            room=str(user_id),
-            namespace="/embedding",
-        )
-        # Process chunks as before
-        for i, (chunk_content, pages) in enumerate(zip(chunks, chunk_pages)):
-            pages_str = None
-            if pages is not None:
-                pages_str = ",".join(map(str, pages))
-            chunk = DocumentChunk(
-                document_id=new_document.id,
-                chunk_index=i,
-                content=chunk_content,
-                tokens=chunk_token_counts[i],
-                pages=pages_str,
+        def save_checkpoint(chunk_index, page):
+            embedding_task.resume_chunk_index = chunk_index
+            embedding_task.resume_page = page
+            session.commit()
+
+        extractor = TextExtractor(embedding_task.temp_path)
+        source = find_ingested_copy(session, embedding_task, user_id) if not stored_indices else None
+        if embedding_task.file_hash and not stored_indices:
+            ChunkEmbeddingCache.record_file(source is not None)
+        if source is not None:
+            logger.info(f"Document {new_document.id} is a copy of document {source.id}, reusing its chunks")
+            result = copy_document_chunks(session, source.id, new_document.id, user_id)
+            page_amount = extractor.count_pages()
+        else:
+            text_pages = extractor.extract_text_from_file(first_page=embedding_task.resume_page)
+            result = run_pipeline(
+                session, embedding_task, user_id, new_document.id, text_pages, client,
+                start_index=embedding_task.resume_chunk_index,
+                stored_indices=[index for index in stored_indices if index >= embedding_task.resume_chunk_index],
+                on_checkpoint=save_checkpoint,
             )
-            session.add(chunk)
-        session.commit()
-        # Emit progress update
-        socketio.emit(
-            "task_progress",
-            {"task_id": embedding_task.task_id, "message": f"Generating embeddings for {embedding_task.title}..."},
-            room=str(user_id),
-            namespace="/embedding",
-        )
-        embeddings = get_embedding_batch(chunks, client)
-        store_embeddings(session, new_document.id, embeddings, user_id)
-        embedding_cost(session=session, user_id=user_id, api_key_id=key_id, input_tokens=total_tokens)
-        socketio.emit(
-            "task_progress",
-            {"task_id": embedding_task.task_id, "message": f"Calculating cost of {embedding_task.title}..."},
-            room=str(user_id),
-            namespace="/embedding",
-        )
-        final_page_count = extractor.last_page_number
-        socketio.emit(
-            "task_complete",
-            {
-                "task_id": embedding_task.task_id,
-                "message": f"Embedding task for {embedding_task.title} has completed.",
-                "status": "completed",
-                "document": {
-                    "title": embedding_task.title,
-                    "author": embedding_task.author,
-                    "chunk_count": len(chunks),
-                    "document_id": new_document.id,
-                    "page_amount": final_page_count,
-                    "total_tokens": total_tokens,
-                },
-            },
-            room=str(user_id),
-            namespace="/embedding",
+            page_amount = extractor.last_page_number
+        vector_sums = [vector_sum for vector_sum in (stored_sum, result.vector_sum) if vector_sum is not None]
+        finish_document(
+            session, embedding_task, user_id, new_document, key_id,
+            chunk_count=len(stored_indices) + result.chunk_count,
+            total_tokens=stored_tokens + result.total_tokens,
+            centroid=normalize(np.sum(vector_sums, axis=0)) if vector_sums else None,
+            page_amount=page_amount,
+            embedded_tokens=stored_tokens + result.embedded_tokens,
+            reused_chunks=result.reused_chunks,
         )
 
     except Exception as e:
         logger.info(f"Error processing document {embedding_task.id}: {e}")
+        if can_retry and new_document is not None and isinstance(e, RETRYABLE_ERRORS):
+            # Keep the document, its committed chunks and the upload so the retry resumes from the checkpoint
+            session.rollback()
+            raise
         os.remove(embedding_task.temp_path)
+        if new_document is not None:
+            discard_document(session, user_id, new_document.id)
         # Emit error event
         socketio.emit(
             "task_update",
@@ -121,11 +290,46 @@ def process_document(session, embedding_task, user_id):
         raise e
 
 
-@celery.task(time_limit=200)
-def process_embedding_task(task_id):
+def page_ranges(page_count, pages_per_task):
+    return [
+        (first_page, min(first_page + pages_per_task - 1, page_count))
+        for first_page in range(1, page_count + 1, pages_per_task)
+    ]
+
+
+def fan_out_document(session, embedding_task, user_id, page_count):
+    """Embed page ranges of a large PDF on separate workers; finalize_document_task runs once all are done."""
+    new_document = create_document(session, embedding_task, user_id)
+    ranges = page_ranges(page_count, current_app.config["EMBEDDING_FANOUT_PAGES_PER_TASK"])
+    logger.info(f"Fanning out {embedding_task.title} ({page_count} pages) into {len(ranges)} page-range tasks")
+    # Keeps cleanup_documents away from the upload until the chord's callbacks have run
+    embedding_task.parts_pending = len(ranges)
+    session.commit()
+    socketio.emit(
+        "task_progress",
+        {"task_id": embedding_task.task_id, "message": f"Extracting text from {embedding_task.title}..."},
+        room=str(user_id),
+        namespace="/embedding",
+    )
+    header = group(
+        embed_page_range_task.s(embedding_task.task_id, new_document.id, part, first_page, last_page)
+        for part, (first_page, last_page) in enumerate(ranges)
+    )
+    callback = finalize_document_task.s(embedding_task.task_id, new_document.id, page_count).on_error(
+        fail_document_task.si(embedding_task.task_id, new_document.id)
+    )
+    chord(header)(callback)
+
+
+@celery.task(
+    bind=True, time_limit=200, soft_time_limit=180, max_retries=3, acks_late=True, reject_on_worker_lost=True
+)
+def process_embedding_task(self, task_id):
     session = make_session()
     embedding_task = None
     task = None
+    keep_temp_file = False
+    retrying = False
     try:
         logger.info(f"Retrieving embedding task with ID '{task_id}'")
         embedding_task = session.query(EmbeddingTask).filter_by(task_id=task_id).first()
@@ -133,11 +337,34 @@ def process_embedding_task(task_id):
         if not embedding_task:
             raise ValueError(f"EmbeddingTask for task ID '{task_id}' not found")
         task = session.query(Task).filter_by(id=task_id).one()
-        process_document(session, embedding_task, user_id=task.user_id)
+        if embedding_task.document_id and embedding_task.resume_page is None:
+            # Redelivered after the document was finished, discarded or handed to page-range tasks
+            keep_temp_file = True
+            return True
+        # Resumed documents and copies of earlier uploads finish on this worker
+        if embedding_task.resume_page is None and find_ingested_copy(session, embedding_task, task.user_id) is None:
+            page_count = TextExtractor(embedding_task.temp_path).count_pages()
+            if page_count and page_count >= current_app.config["EMBEDDING_FANOUT_MIN_PAGES"]:
+                fan_out_document(session, embedding_task, task.user_id, page_count)
+                keep_temp_file = True  # The temp file is removed by finalize_document_task or fail_document_task
+                return True
+        can_retry = self.request.retries < self.max_retries
+        process_document(session, embedding_task, user_id=task.user_id, can_retry=can_retry)
         # Success and completion updates are now handled within process_document
         return True
     except Exception as e:
         session.rollback()
+        # process_document leaves resume_page set only when the document was kept for a retry
+        if isinstance(e, RETRYABLE_ERRORS) and embedding_task is not None and embedding_task.resume_page is not None:
+            retrying = True
+            logger.info(f"Retrying embedding task {task_id} from page {embedding_task.resume_page}: {e}")
+            socketio.emit(
+                "task_progress",
+                {"task_id": task_id, "message": f"Interrupted, resuming {embedding_task.title} shortly..."},
+                room=str(task.user_id),
+                namespace="/embedding",
+            )
+            raise self.retry(exc=e, countdown=RETRY_DELAY * 2 ** self.request.retries)
         socketio.emit(
             "task_update",
             {"task_id": task_id, "status": "error", "error": str(e)},
@@ -145,12 +372,141 @@ def process_embedding_task(task_id):
             namespace="/embedding",
         )
         return False
+    finally:
+        if embedding_task and not (keep_temp_file or retrying):
+            remove_temp_file(embedding_task)
+        session.remove()
+
+
+def remove_temp_file(embedding_task):
+    try:
+        if os.path.exists(embedding_task.temp_path):
+            os.remove(embedding_task.temp_path)
+    except Exception as e:
+        pass
+
+
+# Provisional chunk_index stride between page-range parts; finalize_document_task renumbers chunks contiguously
+PART_INDEX_STRIDE = 1_000_000
+
+
+@celery.task(time_limit=200)
+def embed_page_range_task(task_id, document_id, part, first_page, last_page):
+    session = make_session()
+    try:
+        embedding_task = session.query(EmbeddingTask).filter_by(task_id=task_id).one()
+        user_id = session.query(Task.user_id).filter_by(id=task_id).scalar()
+        client, key_id, error = task_client(session, user_id)
+        if error:
+            raise Exception(error)
+
+        logger.info(f"Embedding pages {first_page}-{last_page} of {embedding_task.title}")
+        text_pages = TextExtractor(embedding_task.temp_path).extract_text_from_file(first_page, last_page)
+        result = run_pipeline(
+            session, embedding_task, user_id, document_id, text_pages, client, start_index=part * PART_INDEX_STRIDE
+        )
+        return {
+            "chunk_count": result.chunk_count,
+            "total_tokens": result.total_tokens,
+            "embedded_tokens": result.embedded_tokens,
+            "reused_chunks": result.reused_chunks,
+            "vector_sum": result.vector_sum.tolist() if result.vector_sum is not None else None,
+        }
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error embedding pages {first_page}-{last_page} of document {document_id}: {e}")
+        raise
+    finally:
+        session.remove()
+
+
+@celery.task(time_limit=200)
+def finalize_document_task(results, task_id, document_id, page_count):
+    session = make_session()
+    embedding_task = None
+    user_id = None
+    try:
+        embedding_task = session.query(EmbeddingTask).filter_by(task_id=task_id).one()
+        user_id = session.query(Task.user_id).filter_by(id=task_id).scalar()
+        _, key_id, _ = task_client(session, user_id)
+
+        # Parts wrote provisional indexes in page order; make them contiguous
+        chunk_ids = [
+            chunk_id
+            for chunk_id, in session.query(DocumentChunk.id)
+            .filter_by(document_id=document_id)
+            .order_by(DocumentChunk.chunk_index)
+        ]
+        session.bulk_update_mappings(
+            DocumentChunk, [{"id": chunk_id, "chunk_index": index} for index, chunk_id in enumerate(chunk_ids)]
+        )
+
+        vector_sums = [np.array(result["vector_sum"], dtype=np.float32) for result in results if result["vector_sum"]]
+        document = session.query(Document).filter_by(id=document_id).one()
+        finish_document(
+            session, embedding_task, user_id, document, key_id,
+            chunk_count=sum(result["chunk_count"] for result in results),
+            total_tokens=sum(result["total_tokens"] for result in results),
+            centroid=normalize(np.sum(vector_sums, axis=0)) if vector_sums else None,
+            page_amount=page_count,
+            embedded_tokens=sum(result["embedded_tokens"] for result in results),
+            reused_chunks=sum(result["reused_chunks"] for result in results),
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error finalizing document {document_id}: {e}")
+        if user_id is not None:
+            discard_document(session, user_id, document_id)
+            socketio.emit(
+                "task_update",
+                {"task_id": task_id, "status": "error", "error": str(e)},
+                room=str(user_id),
+                namespace="/embedding",
+            )
+        return False
     finally:
         if embedding_task:
-            try:
-                if os.path.exists(embedding_task.temp_path):
-                    os.remove(embedding_task.temp_path)
-            except Exception as e:
-                pass
+            remove_temp_file(embedding_task)
         session.remove()
 
+
+@celery.task(time_limit=60)
+def fail_document_task(task_id, document_id):
+    """Chord error callback: hide the partially embedded document and report the failure."""
+    session = make_session()
+    try:
+        embedding_task = session.query(EmbeddingTask).filter_by(task_id=task_id).first()
+        user_id = session.query(Task.user_id).filter_by(id=task_id).scalar()
+        discard_document(session, user_id, document_id)
+        if embedding_task:
+            remove_temp_file(embedding_task)
+        socketio.emit(
+            "task_update",
+            {"task_id": task_id, "status": "error", "error": "Embedding part of the document failed."},
+            room=str(user_id),
+            namespace="/embedding",
+        )
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error cleaning up failed document {document_id}: {e}")
+        return False
+    finally:
+        session.remove()
+
+
+@celery.task(time_limit=600)
+def build_vector_index_task(user_id):
+    session = make_session()
+    try:
+        VectorCache.build_ann_index(user_id)
+        # Let cached entries pick up the new index on their next refresh
+        VectorCache.bump_version(session, user_id)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error building vector index for user {user_id}: {e}")
+        return False
+    finally:
+        session.remove()
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+INDEX_NAME = "ivf.npz"
+ASSIGN_BLOCK_ROWS = 8192  # Rows scored against the centroids at a time while assigning lists
+MAX_TRAINING_ROWS = 16384  # k-means trains on a sample; every row is still assigned afterwards
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], ASSIGN_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+        assignments[start:start + ASSIGN_BLOCK_ROWS] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Cluster unit vectors by inner product and return nlist unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    if vectors.shape[0] > MAX_TRAINING_ROWS:
+        sample = np.sort(rng.choice(vectors.shape[0], MAX_TRAINING_ROWS, replace=False))
+        vectors = vectors[sample]
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    centroids = vectors[rng.choice(vectors.shape[0], nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=nlist)
+
+        # Re-seed empty lists from random rows so every list keeps a centroid
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            sums[empty] = vectors[rng.choice(vectors.shape[0], empty.size, replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted-file index over a user's chunk vectors.
+
+    Lists are stored by chunk ID rather than row so the index survives store compaction and cache reloads;
+    ``bind`` maps them onto the rows of a particular cache entry.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_chunk_ids: np.ndarray):
+        self.centroids = centroids
+        self.list_offsets = list_offsets  # List i holds list_chunk_ids[list_offsets[i]:list_offsets[i + 1]]
+        self.list_chunk_ids = list_chunk_ids
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, chunk_ids: list, nlist: int = None) -> "IVFIndex":
+        if nlist is None:
+            nlist = int(np.sqrt(vectors.shape[0]))
+        nlist = max(1, min(nlist, vectors.shape[0]))
+
+        centroids = spherical_kmeans(vectors, nlist)
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=list_offsets[1:])
+        list_chunk_ids = np.array(chunk_ids)[order]
+        return cls(centroids, list_offsets, list_chunk_ids)
+
+    def save(self, directory: str) -> None:
+        temp_path = os.path.join(directory, f"{INDEX_NAME}.tmp.npz")
+        np.savez(
+            temp_path, centroids=self.centroids, list_offsets=self.list_offsets, list_chunk_ids=self.list_chunk_ids
+        )
+        os.replace(temp_path, os.path.join(directory, INDEX_NAME))
+
+    @staticmethod
+    def remove(directory: str) -> None:
+        path = os.path.join(directory, INDEX_NAME)
+        if os.path.exists(path):
+            os.remove(path)
+
+    @classmethod
+    def load(cls, directory: str):
+        path = os.path.join(directory, INDEX_NAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_chunk_ids"])
+
+    def bind(self, row_by_id: dict) -> "BoundIVFIndex":
+        lists = []
+        indexed = set()
+        for i in range(self.nlist):
+            chunk_ids = self.list_chunk_ids[self.list_offsets[i]:self.list_offsets[i + 1]]
+            rows = [row_by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in row_by_id]
+            indexed.update(rows)
+            lists.append(np.array(rows, dtype=np.intp))
+        # Rows appended since the index was built are always scanned exactly
+        unindexed = np.array(sorted(set(row_by_id.values()) - indexed), dtype=np.intp)
+        return BoundIVFIndex(self.centroids, lists, unindexed)
+
+
+class BoundIVFIndex:
+    __slots__ = ("centroids", "lists", "unindexed")
+
+    def __init__(self, centroids: np.ndarray, lists: list, unindexed: np.ndarray):
+        self.centroids = centroids
+        self.lists = lists  # Cache rows per list
+        self.unindexed = unindexed
+
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes + self.unindexed.nbytes + sum(rows.nbytes for rows in self.lists)
+
+    def candidates(self, query_vector: np.ndarray, nprobe: int) -> np.ndarray:
+        """Return the cache rows in the nprobe lists closest to the query, plus any unindexed rows."""
+        nprobe = min(nprobe, len(self.lists))
+        centroid_scores = self.centroids @ query_vector
+        probed = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        return np.concatenate([self.unindexed] + [self.lists[i] for i in probed])
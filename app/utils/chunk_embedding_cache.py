@@ -0,0 +1,118 @@
+import hashlib
+import threading
+
+import numpy as np
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app.models.embedding_models import EmbeddingCacheEntry
+from app.utils.logging_util import configure_logging
+from app.utils.query_embedding_cache import normalize_query
+
+logger = configure_logging()
+
+LOOKUP_GROUP_SIZE = 500  # Keys per IN (...) query
+
+
+class ChunkEmbeddingCache:
+    """Embeddings of previously ingested chunks, keyed by sha256 of (model, chunk size, normalised text).
+
+    Rows are shared between users and documents, so re-uploads and papers that several users upload are
+    embedded once. Whole files are matched by Document.file_hash before splitting; the counters below cover
+    both levels for the current process.
+    """
+
+    _lock = threading.Lock()
+
+    enabled = True
+    hits = 0
+    misses = 0
+    file_hits = 0
+    file_misses = 0
+
+    @classmethod
+    def configure(cls, enabled: bool = None) -> None:
+        if enabled is not None:
+            cls.enabled = bool(enabled)
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            lookups = cls.hits + cls.misses
+            file_lookups = cls.file_hits + cls.file_misses
+            return {
+                "hits": cls.hits,
+                "misses": cls.misses,
+                "hit_rate": cls.hits / lookups if lookups else 0.0,
+                "file_hits": cls.file_hits,
+                "file_misses": cls.file_misses,
+                "file_hit_rate": cls.file_hits / file_lookups if file_lookups else 0.0,
+            }
+
+    @classmethod
+    def record_file(cls, hit: bool) -> None:
+        with cls._lock:
+            if hit:
+                cls.file_hits += 1
+            else:
+                cls.file_misses += 1
+
+    @staticmethod
+    def make_key(text: str, chunk_size: int, model: str) -> str:
+        return hashlib.sha256(f"{model}\n{chunk_size}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    @classmethod
+    def lookup(cls, engine, keys: list) -> dict:
+        """Cached float32 vectors for the keys that have one. Lookup errors count as misses.
+
+        Takes the engine rather than a session so it can run on threads without an app context.
+        """
+        found = {}
+        if cls.enabled and keys:
+            table = EmbeddingCacheEntry.__table__
+            unique_keys = list(dict.fromkeys(keys))
+            try:
+                with engine.connect() as connection:
+                    for start in range(0, len(unique_keys), LOOKUP_GROUP_SIZE):
+                        rows = connection.execute(
+                            select(table.c.content_hash, table.c.embedding).where(
+                                table.c.content_hash.in_(unique_keys[start:start + LOOKUP_GROUP_SIZE])
+                            )
+                        )
+                        for key, embedding in rows:
+                            found[key] = np.frombuffer(embedding, dtype=np.float32)
+            except SQLAlchemyError as e:
+                logger.error(f"Could not look up cached chunk embeddings: {e}")
+
+        hits = sum(1 for key in keys if key in found)
+        with cls._lock:
+            cls.hits += hits
+            cls.misses += len(keys) - hits
+        return found
+
+    @classmethod
+    def remember(cls, session, keys: list, vectors: np.ndarray, model: str) -> None:
+        """Store freshly embedded chunks. Keys another worker cached first are skipped."""
+        if not cls.enabled or not keys:
+            return
+        entries = {}
+        for key, vector in zip(keys, vectors):
+            entries.setdefault(key, vector)
+        existing = {
+            key
+            for key, in session.query(EmbeddingCacheEntry.content_hash).filter(
+                EmbeddingCacheEntry.content_hash.in_(list(entries))
+            )
+        }
+        rows = [
+            {"content_hash": key, "model": model, "embedding": np.asarray(vector, dtype=np.float32).tobytes()}
+            for key, vector in entries.items()
+            if key not in existing
+        ]
+        if not rows:
+            return
+        try:
+            session.execute(insert(EmbeddingCacheEntry), rows)
+            session.commit()
+        except IntegrityError:
+            session.rollback()  # Raced with another worker caching the same chunk; its copy is as good
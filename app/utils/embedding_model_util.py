@@ -0,0 +1,31 @@
+from app.models.user_models import User
+
+EMBEDDING_MODEL = "text-embedding-3-large"  # Default for users no EmbeddingMigration has moved
+EMBEDDING_DIMENSIONS = {  # Native output sizes; text-embedding-3-* also accept a smaller `dimensions`
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+    "text-embedding-ada-002": 1536,
+}
+
+
+def embedding_model_name(model: str, dimensions: int = None) -> str:
+    """Value of DocumentEmbedding.model: the model, suffixed with the output size when it is not the native one.
+
+    Vectors of the same model at different sizes cannot be compared, so they must not share a name.
+    """
+    if dimensions and dimensions != EMBEDDING_DIMENSIONS.get(model):
+        return f"{model}:{dimensions}"
+    return model
+
+
+def embedding_kwargs(dimensions: int = None) -> dict:
+    """Extra embeddings.create arguments for an output size; empty for the native size."""
+    return {"dimensions": dimensions} if dimensions else {}
+
+
+def user_embedding_model(session, user_id) -> tuple:
+    """(model, dimensions) the user's documents and queries are embedded with; dimensions is None when native."""
+    row = session.query(User.embedding_model, User.embedding_dimensions).filter(User.id == str(user_id)).first()
+    if row is None or not row.embedding_model:
+        return EMBEDDING_MODEL, None
+    return row.embedding_model, row.embedding_dimensions
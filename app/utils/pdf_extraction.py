@@ -0,0 +1,82 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pypdf import PdfReader
+
+from app.utils.logging_util import configure_logging
+
+logger = configure_logging()
+
+PAGES_PER_TASK = 16  # Pages a pool worker extracts per submission
+TASKS_AHEAD_PER_WORKER = 2  # Submissions kept in flight per worker, bounding memory held by finished ranges
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def iter_page_range(filepath: str, first_page: int, last_page: int):
+    """Yield (text, page_number) for every page in the range, in order, from one PdfReader."""
+    with open(filepath, "rb") as file:
+        reader = PdfReader(file)
+        for page_number in range(first_page, last_page + 1):
+            yield reader.pages[page_number - 1].extract_text(), page_number
+
+
+def extract_page_range(filepath: str, first_page: int, last_page: int) -> list:
+    """Pool worker entry point; each call opens its own PdfReader."""
+    return list(iter_page_range(filepath, first_page, last_page))
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    # Only used when PDF_EXTRACTION_WORKERS is set, which is meant for prefork Celery workers; see config.py
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # Spawned rather than forked: forking a worker that runs eventlet and database threads can deadlock
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_pages_parallel(filepath: str, first_page: int, last_page: int, workers: int):
+    """Yield (text, page_number) for every page in the range, in order, extracted by a shared process pool.
+
+    Ranges of PAGES_PER_TASK pages are submitted a few at a time per worker and yielded as soon as every earlier
+    range is done. If the pool cannot be started or breaks, the remaining pages are extracted in this process.
+    """
+    ranges = deque(
+        (start, min(start + PAGES_PER_TASK - 1, last_page)) for start in range(first_page, last_page + 1, PAGES_PER_TASK)
+    )
+    in_flight = deque()
+    next_page = first_page  # First page not yet yielded
+    pool = None
+    try:
+        pool = _get_pool(workers)
+        while ranges or in_flight:
+            while ranges and len(in_flight) < workers * TASKS_AHEAD_PER_WORKER:
+                in_flight.append(pool.submit(extract_page_range, filepath, *ranges.popleft()))
+            for page in in_flight.popleft().result():
+                yield page
+                next_page = page[1] + 1
+    except (BrokenProcessPool, OSError) as e:
+        logger.error(f"Parallel extraction of {filepath} failed, continuing serially from page {next_page}: {e}")
+        if pool is not None:
+            _discard_pool(pool)
+        yield from iter_page_range(filepath, next_page, last_page)
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -0,0 +1,84 @@
+import numpy as np
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+STORAGE_FORMATS = (FLOAT32, FLOAT16, INT8)
+BLOCK_ROWS = 4096  # Rows converted at a time so compact matrices never need a full float32 copy
+
+
+def quantize_int8(vectors: np.ndarray):
+    """Symmetric per-row int8 quantization. Returns (codes, scales) with vectors ~= codes * scales[:, None]."""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def encode_embedding(vector: np.ndarray, storage_format: str = FLOAT32):
+    """Serialise one embedding for DocumentEmbedding.embedding. Returns (bytes, scale or None)."""
+    if storage_format == FLOAT32:
+        return np.asarray(vector, dtype=np.float32).tobytes(), None
+    if storage_format == FLOAT16:
+        return np.asarray(vector, dtype=np.float16).tobytes(), None
+    if storage_format == INT8:
+        codes, scales = quantize_int8(vector)
+        return codes[0].tobytes(), float(scales[0])
+    raise ValueError(f"Unsupported embedding storage format: {storage_format}")
+
+
+def decode_embedding(data: bytes, storage_format: str = FLOAT32, scale: float = None) -> np.ndarray:
+    """Inverse of encode_embedding; rows written before formats were recorded are float32."""
+    if storage_format in (None, FLOAT32):
+        return np.frombuffer(data, dtype=np.float32)
+    if storage_format == FLOAT16:
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+    if storage_format == INT8:
+        return np.frombuffer(data, dtype=np.int8).astype(np.float32) * np.float32(scale)
+    raise ValueError(f"Unsupported embedding storage format: {storage_format}")
+
+
+def compress_matrix(vectors: np.ndarray, storage_format: str):
+    """Build the compact in-memory copy of a (possibly memory-mapped) matrix. Returns (codes, scales or None)."""
+    if storage_format == FLOAT16:
+        codes = np.empty(vectors.shape, dtype=np.float16)
+        for start in range(0, vectors.shape[0], BLOCK_ROWS):
+            codes[start:start + BLOCK_ROWS] = vectors[start:start + BLOCK_ROWS]
+        return codes, None
+    if storage_format == INT8:
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        scales = np.empty(vectors.shape[0], dtype=np.float32)
+        for start in range(0, vectors.shape[0], BLOCK_ROWS):
+            codes[start:start + BLOCK_ROWS], scales[start:start + BLOCK_ROWS] = quantize_int8(
+                vectors[start:start + BLOCK_ROWS]
+            )
+        return codes, scales
+    raise ValueError(f"Unsupported compact cache format: {storage_format}")
+
+
+def compact_scores(codes: np.ndarray, scales, rows: np.ndarray, query_vector: np.ndarray) -> np.ndarray:
+    """Approximate inner products of the query with codes[rows], converting one block at a time.
+
+    query_vector may also be a (dim, n) matrix of queries, giving a (rows, n) score matrix.
+    """
+    scores = np.empty((rows.size,) + query_vector.shape[1:], dtype=np.float32)
+    for start in range(0, rows.size, BLOCK_ROWS):
+        block = rows[start:start + BLOCK_ROWS]
+        scores[start:start + BLOCK_ROWS] = codes[block].astype(np.float32) @ query_vector
+    if scales is not None:
+        scores *= scales[rows].reshape((-1,) + (1,) * (scores.ndim - 1))
+    return scores
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def prefix_matrix(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    """Re-normalised leading dimensions of each row, as text-embedding-3 Matryoshka embeddings allow."""
+    prefix = np.empty((vectors.shape[0], dimensions), dtype=np.float32)
+    for start in range(0, vectors.shape[0], BLOCK_ROWS):
+        prefix[start:start + BLOCK_ROWS] = normalize(vectors[start:start + BLOCK_ROWS, :dimensions])
+    return prefix
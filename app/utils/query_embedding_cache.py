@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from app.utils.logging_util import configure_logging
+
+logger = configure_logging()
+
+DEFAULT_MAX_ENTRIES = 1024  # ~12 MB of text-embedding-3-large vectors
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form used for cache keys: NFC with runs of whitespace collapsed, case preserved."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class QueryEmbeddingCache:
+    """LRU of query embeddings keyed by (model, dimensions, sha256 of the normalised text).
+
+    When a directory is configured, entries are also written there as .npy files so retries and repeated
+    questions are served across processes and restarts.
+    """
+
+    _entries = OrderedDict()  # key -> float32 vector, least recently used first
+    _lock = threading.Lock()
+
+    max_entries = DEFAULT_MAX_ENTRIES
+    directory = None
+    hits = 0
+    disk_hits = 0
+    misses = 0
+
+    @classmethod
+    def configure(cls, max_entries: int = None, directory: str = None) -> None:
+        with cls._lock:
+            if max_entries is not None:
+                cls.max_entries = int(max_entries)
+                while len(cls._entries) > cls.max_entries:
+                    cls._entries.popitem(last=False)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                cls.directory = directory
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        with cls._lock:
+            cls._entries.clear()
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {
+                "entries": len(cls._entries),
+                "max_entries": cls.max_entries,
+                "hits": cls.hits,
+                "disk_hits": cls.disk_hits,
+                "misses": cls.misses,
+            }
+
+    @staticmethod
+    def make_key(text: str, model: str, dimensions=None) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+        return f"{model}-{dimensions or 'native'}-{digest}"
+
+    @classmethod
+    def _path(cls, key: str) -> str:
+        return os.path.join(cls.directory, key[-2:], f"{key}.npy")
+
+    @classmethod
+    def _remember(cls, key: str, vector: np.ndarray) -> None:
+        with cls._lock:
+            cls._entries[key] = vector
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > cls.max_entries:
+                cls._entries.popitem(last=False)
+
+    @classmethod
+    def get(cls, key: str):
+        with cls._lock:
+            vector = cls._entries.get(key)
+            if vector is not None:
+                cls._entries.move_to_end(key)
+                cls.hits += 1
+                return vector
+
+        if cls.directory:
+            try:
+                vector = np.load(cls._path(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not read cached query embedding {key}: {e}")
+            else:
+                vector.setflags(write=False)
+                cls._remember(key, vector)
+                with cls._lock:
+                    cls.disk_hits += 1
+                return vector
+
+        with cls._lock:
+            cls.misses += 1
+        return None
+
+    @classmethod
+    def put(cls, key: str, vector) -> np.ndarray:
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False)  # Shared between callers, so nobody may modify it in place
+        cls._remember(key, vector)
+
+        if cls.directory:
+            path = cls._path(key)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(temp_path, "wb") as file:
+                    np.save(file, vector)
+                os.replace(temp_path, path)
+            except OSError as e:
+                logger.error(f"Could not write cached query embedding {key}: {e}")
+        return vector
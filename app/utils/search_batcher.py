@@ -0,0 +1,127 @@
+import threading
+
+import numpy as np
+
+from app.utils.logging_util import configure_logging
+from app.utils.vector_cache import VectorCache
+
+logger = configure_logging()
+
+DEFAULT_WINDOW = 0.002  # Seconds a leader waits for other queries before searching
+DEFAULT_MAX_BATCH = 32
+
+
+class _Batch:
+    __slots__ = ("queries", "results", "error", "full", "done")
+
+    def __init__(self):
+        self.queries = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()  # Set when max_batch queries have joined, so the leader stops waiting
+        self.done = threading.Event()
+
+
+class SearchBatcher:
+    """Coalesces concurrent VectorCache.top_k calls that search the same user selection.
+
+    A query of a (user, selection, k, nprobe) group that finds no other search of the group running is searched
+    at once. One that arrives while a search is running becomes the leader of a batch: it waits up to ``window``
+    seconds for followers, scores every collected query with one VectorCache.top_k_batch call, and hands each
+    follower its own results. A window of 0 disables batching.
+    """
+
+    _pending = {}  # group key -> _Batch still accepting queries
+    _in_flight = {}  # group key -> searches of the group running now
+    _lock = threading.Lock()  # Green when eventlet has monkey patched threading
+
+    window = DEFAULT_WINDOW
+    max_batch = DEFAULT_MAX_BATCH
+    batches = 0
+    batched_queries = 0
+
+    @classmethod
+    def configure(cls, window: float = None, max_batch: int = None) -> None:
+        with cls._lock:
+            if window is not None:
+                cls.window = float(window)
+            if max_batch is not None:
+                cls.max_batch = max(1, int(max_batch))
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {
+                "batches": cls.batches,
+                "queries": cls.batched_queries,
+                "mean_batch": cls.batched_queries / cls.batches if cls.batches else 0.0,
+            }
+
+    @classmethod
+    def top_k(cls, user_id, query_vector: np.ndarray, k: int, document_ids=None, nprobe: int = None) -> list:
+        """Drop-in replacement for VectorCache.top_k that may share a matrix product with concurrent queries."""
+        if cls.window <= 0 or cls.max_batch <= 1:
+            return VectorCache.top_k(user_id, query_vector, k, document_ids=document_ids, nprobe=nprobe)
+        VectorCache._check_query_vector(query_vector)
+
+        selection = None if document_ids is None else tuple(sorted(document_ids))
+        key = (str(user_id), selection, k, nprobe, query_vector.shape[0])
+        with cls._lock:
+            batch = cls._pending.get(key)
+            alone = batch is None and not cls._in_flight.get(key)
+            leader = batch is None
+            if alone:
+                # Nothing to share a product with, so don't make the query wait for the window
+                cls._in_flight[key] = 1
+                cls.batches += 1
+                cls.batched_queries += 1
+            else:
+                if leader:
+                    batch = cls._pending[key] = _Batch()
+                position = len(batch.queries)
+                batch.queries.append(query_vector)
+                if len(batch.queries) >= cls.max_batch:
+                    del cls._pending[key]
+                    batch.full.set()
+
+        if alone:
+            try:
+                return VectorCache.top_k(user_id, query_vector, k, document_ids=document_ids, nprobe=nprobe)
+            finally:
+                cls._finish(key)
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.results[position]
+
+        batch.full.wait(cls.window)
+        with cls._lock:
+            if cls._pending.get(key) is batch:
+                del cls._pending[key]
+            cls._in_flight[key] = cls._in_flight.get(key, 0) + 1
+            cls.batches += 1
+            cls.batched_queries += len(batch.queries)
+
+        try:
+            batch.results = VectorCache.top_k_batch(
+                user_id, np.stack(batch.queries).astype(np.float32, copy=False), k, document_ids=document_ids,
+                nprobe=nprobe,
+            )
+        except Exception as e:
+            logger.error(f"Batched vector search for user {user_id} failed: {e}")
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+            cls._finish(key)
+        return batch.results[position]
+
+    @classmethod
+    def _finish(cls, key) -> None:
+        with cls._lock:
+            remaining = cls._in_flight.get(key, 0) - 1
+            if remaining > 0:
+                cls._in_flight[key] = remaining
+            else:
+                cls._in_flight.pop(key, None)
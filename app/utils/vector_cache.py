@@ -1,67 +1,691 @@
-import pickle
 import threading
+from collections import OrderedDict
+
 import numpy as np
-from sqlalchemy.orm import load_only
 
+from app import db
 from app.models.embedding_models import Document, DocumentChunk, DocumentEmbedding
+from app.models.user_models import TierLimit, User
+from app.utils.ann_index import IVFIndex
+from app.utils.embedding_model_util import EMBEDDING_MODEL, embedding_model_name, user_embedding_model
+from app.utils.logging_util import configure_logging
+from app.utils.quantization import (
+    BLOCK_ROWS,
+    FLOAT32,
+    STORAGE_FORMATS,
+    compact_scores,
+    compress_matrix,
+    decode_embedding,
+    normalize,
+    prefix_matrix,
+)
+from app.utils.vector_store import VectorStore
+
+logger = configure_logging()
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # Budget shared by every cached user matrix
+DEFAULT_ANN_MIN_ROWS = 20000  # Below this many searchable rows exact search is fast enough
+DEFAULT_ANN_NPROBE = 8
+RESCORE_FACTOR = 4  # Compact-format candidates rescored at full precision per requested result
+DEFAULT_COARSE_CANDIDATES = 256  # Prefix-pass candidates reranked with the full vectors
+DEFAULT_ROUTE_FANOUT = 8  # Best-matching documents whose chunks are searched when routing
+DEFAULT_ROUTE_MIN_ROWS = 20000  # Smaller selections are cheap enough to search in full
+
+
+class UserVectors:
+    __slots__ = (
+        "vectors", "ids", "row_by_id", "document_ids", "document_index", "document_codes", "selected", "ann",
+        "codes", "scales", "coarse", "version", "store_position", "tokens", "centroids",
+    )
+
+    def __init__(self, vectors: np.ndarray, ids: list, document_ids: list, document_codes: np.ndarray,
+                 selected: np.ndarray):
+        self.vectors = vectors  # One row per chunk
+        self.ids = ids  # Chunk IDs, aligned with the rows of vectors
+        self.row_by_id = {chunk_id: row for row, chunk_id in enumerate(ids) if document_codes[row] >= 0}
+        self.document_ids = document_ids  # Distinct document IDs, indexed by document code
+        self.document_index = {document_id: code for code, document_id in enumerate(document_ids)}
+        self.document_codes = document_codes  # Per-row index into document_ids, -1 for dead rows
+        self.selected = selected  # Per-row flag mirroring Document.selected
+        self.ann = None  # BoundIVFIndex, only attached to large corpora
+        self.codes = None  # Compact float16/int8 copy of vectors searched first when VECTOR_CACHE_FORMAT asks for it
+        self.scales = None  # Per-row int8 scales
+        self.coarse = None  # Normalised Matryoshka prefix of vectors for the first retrieval pass
+        self.version = None  # User.vector_version this entry reflects
+        self.store_position = None  # VectorStore position the rows were read up to; None when not store-backed
+        self.tokens = {}  # chunk_id -> DocumentChunk.tokens, filled in as chunks are first ranked
+        self.centroids = None  # One unit vector per document code, for routing queries to documents
+
+    @classmethod
+    def empty(cls) -> "UserVectors":
+        return cls(np.empty((0, 0), dtype=np.float32), [], [], np.empty(0, dtype=np.int32), np.empty(0, dtype=bool))
+
+    @property
+    def nbytes(self) -> int:
+        # Memory-mapped vectors live in the shared page cache, so only private arrays count against the budget
+        vector_bytes = 0 if isinstance(self.vectors, np.memmap) else self.vectors.nbytes
+        index_bytes = self.ann.nbytes if self.ann is not None else 0
+        compact_bytes = sum(
+            array.nbytes for array in (self.codes, self.scales, self.coarse, self.centroids) if array is not None
+        )
+        # tokens is left out: chunk_tokens grows it in place after the entry is counted, so its size would drift
+        return vector_bytes + index_bytes + compact_bytes + self.document_codes.nbytes + self.selected.nbytes
+
+    def document_mask(self, document_ids=None) -> np.ndarray:
+        if document_ids is None:
+            return self.selected
+        codes = [self.document_index[document_id] for document_id in document_ids if document_id in self.document_index]
+        return np.isin(self.document_codes, codes)
 
 
 class VectorCache:
     _instance = None
-    _vectors = np.array([])  # Store vectors as a single numpy array
-    _ids = []  # Store corresponding chunk IDs
-    _lock = threading.RLock()
+    _entries = OrderedDict()  # user_id -> UserVectors, least recently used first
+    _user_locks = {}  # user_id -> lock serialising loads for that user
+    _total_bytes = 0
+    _lock = threading.RLock()  # Green when eventlet has monkey patched threading
+
+    max_bytes = DEFAULT_MAX_BYTES
+    ann_min_rows = DEFAULT_ANN_MIN_ROWS
+    ann_nprobe = DEFAULT_ANN_NPROBE  # IVF lists probed per query; higher trades latency for recall
+    cache_format = FLOAT32
+    coarse_dimensions = 0  # Default prefix size when the user's tier sets no embed_dimensions; 0 disables it
+    coarse_candidates = DEFAULT_COARSE_CANDIDATES
+    route_fanout = DEFAULT_ROUTE_FANOUT  # 0 disables document routing
+    route_min_rows = DEFAULT_ROUTE_MIN_ROWS
+    hits = 0
+    misses = 0
+    refreshes = 0
+    evictions = 0
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(VectorCache, cls).__new__(cls)
         return cls._instance
 
+    @classmethod
+    def configure(cls, max_bytes: int = None, ann_min_rows: int = None, ann_nprobe: int = None,
+                  cache_format: str = None, coarse_dimensions: int = None, coarse_candidates: int = None,
+                  route_fanout: int = None, route_min_rows: int = None) -> None:
+        if cache_format is not None and cache_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unsupported vector cache format: {cache_format}")
+        with cls._lock:
+            if max_bytes is not None:
+                cls.max_bytes = int(max_bytes)
+            if ann_min_rows is not None:
+                cls.ann_min_rows = int(ann_min_rows)
+            if ann_nprobe is not None:
+                cls.ann_nprobe = int(ann_nprobe)
+            if coarse_candidates is not None:
+                cls.coarse_candidates = int(coarse_candidates)
+            if route_min_rows is not None:
+                cls.route_min_rows = int(route_min_rows)
+            if route_fanout is not None and int(route_fanout) != cls.route_fanout:
+                cls.route_fanout = int(route_fanout)
+                cls._entries.clear()
+                cls._total_bytes = 0
+            if coarse_dimensions is not None and int(coarse_dimensions) != cls.coarse_dimensions:
+                cls.coarse_dimensions = int(coarse_dimensions)
+                cls._entries.clear()
+                cls._total_bytes = 0
+            if cache_format is not None and cache_format != cls.cache_format:
+                cls.cache_format = cache_format
+                cls._entries.clear()
+                cls._total_bytes = 0
+            cls._evict_over_budget()
+
     @classmethod
     def clear_cache(cls) -> None:
         with cls._lock:
-            cls._vectors = np.array([])
-            cls._ids = []
+            cls._entries.clear()
+            cls._total_bytes = 0
 
     @classmethod
-    def load_user_vectors(cls, user_id: int) -> None:
-        cls.clear_cache()
-        embeddings = (
-            DocumentEmbedding.query
+    def evict_user(cls, user_id) -> None:
+        with cls._lock:
+            entry = cls._entries.pop(str(user_id), None)
+            if entry is not None:
+                cls._total_bytes -= entry.nbytes
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {
+                "users": len(cls._entries),
+                "bytes": cls._total_bytes,
+                "max_bytes": cls.max_bytes,
+                "hits": cls.hits,
+                "misses": cls.misses,
+                "refreshes": cls.refreshes,
+                "evictions": cls.evictions,
+            }
+
+    @classmethod
+    def _user_lock(cls, user_id: str) -> threading.Lock:
+        with cls._lock:
+            lock = cls._user_locks.get(user_id)
+            if lock is None:
+                lock = cls._user_locks[user_id] = threading.Lock()
+            return lock
+
+    @classmethod
+    def _lookup(cls, user_id: str, version):
+        """Return the cached entry if it reflects the given version, counting a hit."""
+        with cls._lock:
+            entry = cls._entries.get(user_id)
+            if entry is None or entry.version != version:
+                return None
+            cls._entries.move_to_end(user_id)
+            cls.hits += 1
+            return entry
+
+    @staticmethod
+    def _current_version(user_id: str):
+        return db.session.query(User.vector_version).filter(User.id == user_id).scalar()
+
+    @staticmethod
+    def bump_version(session, user_id) -> None:
+        """Mark the user's cached vectors stale in every process; call in the transaction that makes the change."""
+        session.query(User).filter(User.id == str(user_id)).update(
+            {User.vector_version: User.vector_version + 1}, synchronize_session=False
+        )
+
+    @classmethod
+    def _store(cls, user_id: str, entry: UserVectors) -> None:
+        with cls._lock:
+            previous = cls._entries.pop(user_id, None)
+            if previous is not None:
+                cls._total_bytes -= previous.nbytes
+            cls._entries[user_id] = entry
+            cls._total_bytes += entry.nbytes
+            cls._evict_over_budget(keep=user_id)
+
+    @classmethod
+    def _evict_over_budget(cls, keep: str = None) -> None:
+        # The entry that was just loaded is never evicted, even if it alone exceeds the budget
+        for user_id in list(cls._entries):
+            if cls._total_bytes <= cls.max_bytes:
+                break
+            if user_id == keep:
+                continue
+            entry = cls._entries.pop(user_id)
+            cls._total_bytes -= entry.nbytes
+            cls.evictions += 1
+            logger.info(f"Evicted vectors for user {user_id} ({entry.nbytes} bytes) from the vector cache")
+
+    @staticmethod
+    def _active_model(user_id: str) -> str:
+        """DocumentEmbedding.model of the vectors the user's queries are compared against."""
+        return embedding_model_name(*user_embedding_model(db.session, user_id))
+
+    @staticmethod
+    def _store_matches(snapshot, model: str) -> bool:
+        return (snapshot.model or EMBEDDING_MODEL) == model
+
+    @staticmethod
+    def _query_embeddings(user_id: str, model: str, document_ids=None) -> list:
+        query = (
+            db.session.query(
+                DocumentEmbedding.chunk_id,
+                DocumentEmbedding.embedding,
+                DocumentEmbedding.storage_format,
+                DocumentEmbedding.scale,
+                DocumentChunk.document_id,
+            )
             .join(DocumentChunk, DocumentChunk.id == DocumentEmbedding.chunk_id)
             .join(Document, Document.id == DocumentChunk.document_id)
-            .filter(DocumentEmbedding.user_id == user_id, Document.delete == False)
-            .options(load_only(DocumentEmbedding.chunk_id, DocumentEmbedding.embedding))
-            .all()
+            .filter(DocumentEmbedding.user_id == user_id, DocumentEmbedding.model == model, Document.delete == False)
+        )
+        if document_ids is not None:
+            query = query.filter(DocumentChunk.document_id.in_(document_ids))
+        return query.order_by(DocumentChunk.document_id, DocumentChunk.chunk_index).all()
+
+    @staticmethod
+    def _decode(embedding) -> np.ndarray:
+        return decode_embedding(embedding.embedding, embedding.storage_format, embedding.scale)
+
+    @classmethod
+    def _build_entry(cls, vectors: np.ndarray, chunk_ids: list, row_document_ids: list, documents: dict,
+                     tombstones=frozenset(), coarse_dimensions: int = 0) -> UserVectors:
+        """Align rows with the live documents; rows of deleted, tombstoned or duplicated chunks get code -1."""
+        document_ids = list(documents)
+        document_index = {document_id: code for code, document_id in enumerate(document_ids)}
+
+        document_codes = np.empty(len(chunk_ids), dtype=np.int32)
+        seen = set()
+        for row, (chunk_id, document_id) in enumerate(zip(chunk_ids, row_document_ids)):
+            code = document_index.get(document_id, -1)
+            if chunk_id in seen or document_id in tombstones:
+                code = -1
+            seen.add(chunk_id)
+            document_codes[row] = code
+
+        document_selected = np.array([bool(documents[document_id]) for document_id in document_ids] + [False])
+        selected = document_selected[document_codes]  # Code -1 picks the trailing False
+        entry = UserVectors(vectors, list(chunk_ids), document_ids, document_codes, selected)
+        if 0 < coarse_dimensions < vectors.shape[1]:
+            entry.coarse = prefix_matrix(vectors, coarse_dimensions)
+        elif cls.cache_format != FLOAT32 and vectors.size:
+            entry.codes, entry.scales = compress_matrix(vectors, cls.cache_format)
+        return entry
+
+    @classmethod
+    def _extend_entry(cls, entry: UserVectors, snapshot, documents: dict) -> UserVectors:
+        """Build a new entry from a cached one plus the rows appended since, re-aligned with the live documents.
+
+        Existing rows keep their positions, so only document codes and the appended rows are recomputed.
+        """
+        document_ids = list(documents)
+        document_index = {document_id: code for code, document_id in enumerate(document_ids)}
+
+        # Remap old codes into the new document list; documents that are gone map to -1
+        remap = np.array([document_index.get(document_id, -1) for document_id in entry.document_ids] + [-1],
+                         dtype=np.int32)
+        old_codes = remap[entry.document_codes]
+
+        new_codes = np.empty(len(snapshot.chunk_ids), dtype=np.int32)
+        seen = set(entry.ids)
+        for row, (chunk_id, document_id) in enumerate(zip(snapshot.chunk_ids, snapshot.document_ids)):
+            code = document_index.get(document_id, -1)
+            if chunk_id in seen or document_id in snapshot.tombstones:
+                code = -1
+            seen.add(chunk_id)
+            new_codes[row] = code
+
+        document_codes = np.concatenate([old_codes, new_codes])
+        document_selected = np.array([bool(documents[document_id]) for document_id in document_ids] + [False])
+        extended = UserVectors(
+            snapshot.vectors, entry.ids + snapshot.chunk_ids, document_ids, document_codes,
+            document_selected[document_codes],
+        )
+
+        appended = snapshot.vectors[snapshot.start_row:]
+        if entry.coarse is not None:
+            extended.coarse = np.concatenate([entry.coarse, prefix_matrix(appended, entry.coarse.shape[1])])
+        elif entry.codes is not None:
+            codes, scales = compress_matrix(appended, cls.cache_format)
+            extended.codes = np.concatenate([entry.codes, codes])
+            extended.scales = np.concatenate([entry.scales, scales]) if scales is not None else None
+        extended.tokens = entry.tokens  # Chunks never change, so token counts carry over
+        return extended
+
+    @classmethod
+    def _attach_ann_index(cls, entry: UserVectors, store: VectorStore) -> None:
+        if len(entry.row_by_id) >= cls.ann_min_rows:
+            index = IVFIndex.load(store.directory)
+            if index is not None:
+                entry.ann = index.bind(entry.row_by_id)
+
+    @classmethod
+    def _coarse_dimensions(cls, user_id: str) -> int:
+        tier_dimensions = (
+            db.session.query(TierLimit.embed_dimensions)
+            .join(User, User.role_id == TierLimit.role_id)
+            .filter(User.id == user_id)
+            .scalar()
         )
+        return tier_dimensions if tier_dimensions is not None else cls.coarse_dimensions
 
+    @classmethod
+    def _backfill_store(cls, store: VectorStore, user_id: str, model: str, document_ids: list) -> None:
+        """Copy embeddings that are only in the database (e.g. written before the store existed) into the store."""
+        embeddings = cls._query_embeddings(user_id, model, document_ids)
         if not embeddings:
-            cls.clear_cache()
             return
+        store.append(
+            [str(embedding.chunk_id) for embedding in embeddings],
+            [embedding.document_id for embedding in embeddings],
+            np.stack([cls._decode(embedding) for embedding in embeddings]),
+            model,
+        )
+        logger.info(f"Backfilled {len(embeddings)} vectors into the vector store of user {user_id}")
 
-        with cls._lock:
-            cls._vectors = np.stack([np.frombuffer(embedding.embedding, dtype=np.float32) for embedding in embeddings])
-            cls._ids = [str(embedding.chunk_id) for embedding in embeddings]
+    @classmethod
+    def _fetch_from_database(cls, user_id: str, documents: dict, model: str,
+                             coarse_dimensions: int = 0) -> UserVectors:
+        embeddings = cls._query_embeddings(user_id, model)
+        if not embeddings:
+            return UserVectors.empty()
+        vectors = np.stack([cls._decode(embedding) for embedding in embeddings])
+        return cls._build_entry(
+            vectors,
+            [str(embedding.chunk_id) for embedding in embeddings],
+            [embedding.document_id for embedding in embeddings],
+            documents,
+            coarse_dimensions=coarse_dimensions,
+        )
+
+    @classmethod
+    def _attach_centroids(cls, entry: UserVectors, previous: UserVectors = None) -> None:
+        """Align per-document centroids with the entry's document codes.
+
+        Centroids carry over from the previous entry or come from Document.centroid; documents embedded before
+        centroids were stored are averaged from their cached rows.
+        """
+        if cls.route_fanout <= 0 or not entry.document_ids or entry.vectors.size == 0:
+            return
+        dimensions = entry.vectors.shape[1]
+        known = {}
+        if previous is not None and previous.centroids is not None:
+            known = {document_id: previous.centroids[code] for code, document_id in enumerate(previous.document_ids)}
+        missing = [document_id for document_id in entry.document_ids if document_id not in known]
+        if missing:
+            for document_id, centroid in db.session.query(Document.id, Document.centroid).filter(
+                Document.id.in_(missing), Document.centroid.isnot(None)
+            ):
+                vector = np.frombuffer(centroid, dtype=np.float32)
+                if vector.shape[0] == dimensions:
+                    known[document_id] = vector
+
+        centroids = np.zeros((len(entry.document_ids), dimensions), dtype=np.float32)
+        unresolved = []
+        for code, document_id in enumerate(entry.document_ids):
+            if document_id in known:
+                centroids[code] = known[document_id]
+            else:
+                unresolved.append(code)
+        if unresolved:
+            rows = np.flatnonzero(np.isin(entry.document_codes, unresolved))
+            sums = np.zeros_like(centroids)
+            for start in range(0, rows.size, BLOCK_ROWS):
+                block = rows[start:start + BLOCK_ROWS]
+                np.add.at(sums, entry.document_codes[block], entry.vectors[block])
+            centroids[unresolved] = normalize(sums[unresolved])
+        entry.centroids = centroids
+
+    @staticmethod
+    def _live_documents(user_id: str) -> dict:
+        return dict(
+            db.session.query(Document.id, Document.selected).filter(Document.user_id == user_id, Document.delete == False)
+        )
+
+    @classmethod
+    def _refresh_user_vectors(cls, entry: UserVectors, user_id: str):
+        """Apply document additions, deletions and selection changes to a store-backed entry.
+
+        Returns None when the entry has to be rebuilt from scratch instead (not store-backed, or compacted).
+        """
+        if entry.store_position is None:
+            return None
+        documents = cls._live_documents(user_id)
+        model = cls._active_model(user_id)
+        store = VectorStore(user_id)
+        try:
+            snapshot = store.read(after=entry.store_position)
+            if snapshot is None or snapshot.start_row != len(entry.ids) or not cls._store_matches(snapshot, model):
+                return None
+            present = {entry.document_ids[code] for code in np.unique(entry.document_codes) if code >= 0}
+            present.update(snapshot.document_ids)
+            missing = [document_id for document_id in documents if document_id not in present]
+            if missing:
+                cls._backfill_store(store, user_id, model, missing)
+                snapshot = store.read(after=entry.store_position)
+                if snapshot.start_row != len(entry.ids):
+                    return None
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.error(f"Could not refresh vectors for user {user_id} from the vector store: {e}")
+            return None
+
+        extended = cls._extend_entry(entry, snapshot, documents)
+        extended.store_position = snapshot.position
+        cls._attach_ann_index(extended, store)
+        cls._attach_centroids(extended, entry)
+        return extended
+
+    @classmethod
+    def _fetch_user_vectors(cls, user_id: str) -> UserVectors:
+        documents = cls._live_documents(user_id)
+        if not documents:
+            return UserVectors.empty()
+
+        # Vectors come from the user's memory-mapped store; the database only fills in documents it lacks
+        coarse_dimensions = cls._coarse_dimensions(user_id)
+        model = cls._active_model(user_id)
+        store = VectorStore(user_id)
+        try:
+            snapshot = store.read()
+            # Until a migration has rewritten the store, it holds the vectors of the user's previous model
+            if snapshot is not None and not cls._store_matches(snapshot, model):
+                raise ValueError(f"the vector store holds {snapshot.model or EMBEDDING_MODEL} vectors, not {model}")
+            stored = set(snapshot.document_ids) - snapshot.tombstones if snapshot else set()
+            missing = [document_id for document_id in documents if document_id not in stored]
+            if missing:
+                cls._backfill_store(store, user_id, model, missing)
+                snapshot = store.read()
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.error(f"Falling back to database vectors for user {user_id}: {e}")
+            entry = cls._fetch_from_database(user_id, documents, model, coarse_dimensions)
+            cls._attach_centroids(entry)
+            return entry
+
+        if snapshot is None:
+            return UserVectors.empty()
+        entry = cls._build_entry(
+            snapshot.vectors, snapshot.chunk_ids, snapshot.document_ids, documents, snapshot.tombstones,
+            coarse_dimensions,
+        )
+        entry.store_position = snapshot.position
+        cls._attach_ann_index(entry, store)
+        cls._attach_centroids(entry)
+        return entry
+
+    @classmethod
+    def build_ann_index(cls, user_id) -> bool:
+        """Rebuild the user's IVF index from their live vectors. Returns False when the corpus is too small."""
+        user_id = str(user_id)
+        entry = cls._fetch_user_vectors(user_id)
+        store = VectorStore(user_id)
+        if len(entry.row_by_id) < cls.ann_min_rows:
+            IVFIndex.remove(store.directory)
+            return False
+
+        rows = np.fromiter(entry.row_by_id.values(), dtype=np.intp)
+        index = IVFIndex.build(entry.vectors[rows], [entry.ids[row] for row in rows])
+        index.save(store.directory)
+        logger.info(f"Built IVF index with {index.nlist} lists over {rows.size} vectors for user {user_id}")
+        return True
+
+    @classmethod
+    def load_user_vectors(cls, user_id) -> UserVectors:
+        """Warm the cache for a page view; a no-op while the user's vector version is unchanged."""
+        return cls.get_user_vectors(user_id)
+
+    @classmethod
+    def get_user_vectors(cls, user_id) -> UserVectors:
+        """Return a user's cached vectors, loading them on a miss and refreshing them when their version moved."""
+        user_id = str(user_id)
+        version = cls._current_version(user_id)
+        entry = cls._lookup(user_id, version)
+        if entry is not None:
+            return entry
+
+        with cls._user_lock(user_id):
+            # Another greenlet may have finished loading while we waited for the lock
+            entry = cls._lookup(user_id, version)
+            if entry is not None:
+                return entry
+
+            with cls._lock:
+                stale = cls._entries.get(user_id)
+            entry = cls._refresh_user_vectors(stale, user_id) if stale is not None else None
+            with cls._lock:
+                if entry is not None:
+                    cls.refreshes += 1
+                else:
+                    cls.misses += 1
+            if entry is None:
+                entry = cls._fetch_user_vectors(user_id)
+            entry.version = version
+            cls._store(user_id, entry)
+            return entry
 
     @classmethod
-    def mips_naive(cls, query_vector: np.ndarray, subset_ids: list) -> list:
+    def chunk_tokens(cls, user_id, chunk_ids: list) -> dict:
+        """Token counts of the given chunks, read from the database only for chunks the cache has not seen."""
+        with cls._lock:
+            entry = cls._entries.get(str(user_id))
+            tokens = entry.tokens if entry is not None else {}
+            known = {chunk_id: tokens[chunk_id] for chunk_id in chunk_ids if chunk_id in tokens}
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in known]
+        if missing:
+            # Read outside the lock, then merge into whichever entry the user has by now
+            fetched = {
+                str(chunk_id): count
+                for chunk_id, count in db.session.query(DocumentChunk.id, DocumentChunk.tokens).filter(
+                    DocumentChunk.id.in_(missing)
+                )
+            }
+            known.update(fetched)
+            with cls._lock:
+                entry = cls._entries.get(str(user_id))
+                if entry is not None:
+                    entry.tokens.update(fetched)
+        return {chunk_id: known[chunk_id] for chunk_id in chunk_ids if chunk_id in known}
+
+    @staticmethod
+    def _check_query_vector(query_vector) -> None:
         if not isinstance(query_vector, np.ndarray):
             raise ValueError("Query vector must be a numpy array.")
         if query_vector.ndim != 1:
             raise ValueError("Query vector must be a 1D array.")
 
-        with cls._lock:
-            if cls._vectors.size == 0:
-                return []
+    @staticmethod
+    def _rank(scores: np.ndarray, k: int) -> np.ndarray:
+        """Return the positions of the k highest scores, best first."""
+        if k < scores.size:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(scores.size)
+        return top[np.argsort(scores[top])[::-1]]
+
+    @classmethod
+    def _rescore(cls, entry: UserVectors, rows: np.ndarray, query_vector: np.ndarray, k: int) -> list:
+        """Score rows at full precision and return the best k as (chunk_id, score) pairs."""
+        # Skip the gather only for a full scan in row order; IVF candidates can cover every row in list order
+        if rows.size == len(entry.ids) and np.all(rows[1:] > rows[:-1]):
+            scores = entry.vectors @ query_vector
+        else:
+            scores = entry.vectors[rows] @ query_vector
+        return cls._results(entry, rows, scores, k)
+
+    @classmethod
+    def _results(cls, entry: UserVectors, rows: np.ndarray, scores: np.ndarray, k: int) -> list:
+        top = cls._rank(scores, k)
+        return [(entry.ids[rows[i]], float(scores[i])) for i in top]
+
+    @classmethod
+    def _routes(cls, entry: UserVectors, mask: np.ndarray):
+        """Return the codes of the selected documents if the selection is large enough to route, else None."""
+        if entry.centroids is None or cls.route_fanout <= 0 or np.count_nonzero(mask) < cls.route_min_rows:
+            return None
+        codes = np.flatnonzero(np.bincount(entry.document_codes[mask], minlength=len(entry.document_ids)))
+        return codes if codes.size > cls.route_fanout else None
+
+    @classmethod
+    def _route(cls, entry: UserVectors, mask: np.ndarray, codes: np.ndarray, query_vector: np.ndarray):
+        """Narrow the mask to the chunks of the route_fanout documents whose centroids best match the query."""
+        best = codes[cls._rank(entry.centroids[codes] @ query_vector, cls.route_fanout)]
+        chosen = np.zeros(len(entry.document_ids) + 1, dtype=bool)  # Trailing False for dead rows (code -1)
+        chosen[best] = True
+        return mask & chosen[entry.document_codes]
+
+    @classmethod
+    def _search(cls, entry: UserVectors, mask: np.ndarray, query_vector: np.ndarray, k: int, nprobe: int = None):
+        codes = cls._routes(entry, mask)
+        if codes is not None:
+            routed = cls._route(entry, mask, codes, query_vector)
+            if np.count_nonzero(routed) >= k:
+                mask = routed
+
+        rows = None
+        if entry.ann is not None and np.count_nonzero(mask) >= cls.ann_min_rows:
+            candidates = entry.ann.candidates(query_vector, nprobe or cls.ann_nprobe)
+            rows = candidates[mask[candidates]]
+            if rows.size < k:
+                rows = None  # The probed lists barely overlap the selection, so search it exactly
+        if rows is None:
+            rows = np.flatnonzero(mask)
+        if rows.size == 0:
+            return []
 
-            subset_indices = [cls._ids.index(str(chunk_id)) for chunk_id in subset_ids if str(chunk_id) in cls._ids]
-            subset_vectors = cls._vectors[subset_indices]
+        if entry.coarse is not None and rows.size > max(k * RESCORE_FACTOR, cls.coarse_candidates):
+            # First pass over the short prefix vectors, reranked with the full vectors below
+            coarse_query = normalize(query_vector[:entry.coarse.shape[1]])
+            approximate = entry.coarse[rows] @ coarse_query
+            rows = rows[cls._rank(approximate, max(k * RESCORE_FACTOR, cls.coarse_candidates))]
+        elif entry.codes is not None and rows.size > k * RESCORE_FACTOR:
+            # Shortlist on the compact copy, then rescore the shortlist at full precision below
+            approximate = compact_scores(entry.codes, entry.scales, rows, query_vector)
+            rows = rows[cls._rank(approximate, k * RESCORE_FACTOR)]
+        return cls._rescore(entry, rows, query_vector, k)
 
-        # Calculate dot products using NumPy's vectorized operations
-        similarities = np.dot(subset_vectors, query_vector)
+    @classmethod
+    def top_k(cls, user_id, query_vector: np.ndarray, k: int, document_ids=None, nprobe: int = None) -> list:
+        """Return up to k (chunk_id, score) pairs for the selected documents, best first.
+
+        When document_ids is None the cached Document.selected column decides which rows are searched. Large
+        selections are first narrowed to the route_fanout documents whose centroids best match the query, and
+        searched approximately through the user's IVF index, probing nprobe lists.
+        """
+        cls._check_query_vector(query_vector)
+
+        entry = cls.get_user_vectors(user_id)
+        if entry.vectors.size == 0 or k <= 0:
+            return []
+        return cls._search(entry, entry.document_mask(document_ids), query_vector, k, nprobe)
+
+    @classmethod
+    def top_k_batch(cls, user_id, query_vectors: np.ndarray, k: int, document_ids=None, nprobe: int = None) -> list:
+        """top_k for each row of query_vectors against the same selection, returning one result list per query.
+
+        Exact, prefix and compact passes score every query with a single matrix-matrix product. IVF and
+        document-routed searches narrow the rows differently per query and so still run one at a time.
+        """
+        if not isinstance(query_vectors, np.ndarray) or query_vectors.ndim != 2:
+            raise ValueError("Query vectors must be a 2D numpy array.")
+
+        entry = cls.get_user_vectors(user_id)
+        if entry.vectors.size == 0 or k <= 0:
+            return [[] for _ in query_vectors]
 
-        # Combine IDs and similarities, then sort by similarity score in descending order
-        ranked_similarities = sorted(zip([cls._ids[i] for i in subset_indices], similarities), key=lambda x: x[1],
-                                     reverse=True)
+        mask = entry.document_mask(document_ids)
+        rows = np.flatnonzero(mask)
+        if rows.size == 0:
+            return [[] for _ in query_vectors]
+        if (entry.ann is not None and rows.size >= cls.ann_min_rows) or cls._routes(entry, mask) is not None:
+            # Probed lists and routed documents differ per query, so these are searched one at a time
+            return [cls._search(entry, mask, query_vector, k, nprobe) for query_vector in query_vectors]
+
+        if entry.coarse is not None and rows.size > max(k * RESCORE_FACTOR, cls.coarse_candidates):
+            shortlist = max(k * RESCORE_FACTOR, cls.coarse_candidates)
+            approximate = entry.coarse[rows] @ normalize(query_vectors[:, :entry.coarse.shape[1]]).T
+        elif entry.codes is not None and rows.size > k * RESCORE_FACTOR:
+            shortlist = k * RESCORE_FACTOR
+            approximate = compact_scores(entry.codes, entry.scales, rows, query_vectors.T)
+        else:
+            scores = (entry.vectors if rows.size == len(entry.ids) else entry.vectors[rows]) @ query_vectors.T
+            return [cls._results(entry, rows, scores[:, i], k) for i in range(len(query_vectors))]
+
+        return [
+            cls._rescore(entry, rows[cls._rank(approximate[:, i], shortlist)], query_vector, k)
+            for i, query_vector in enumerate(query_vectors)
+        ]
+
+    @classmethod
+    def mips_naive(cls, user_id, query_vector: np.ndarray, subset_ids: list) -> list:
+        """Score an explicit list of chunk IDs, returning every (chunk_id, score) pair best first."""
+        cls._check_query_vector(query_vector)
+
+        entry = cls.get_user_vectors(user_id)
+        if entry.vectors.size == 0:
+            return []
+
+        rows = np.array(
+            [entry.row_by_id[chunk_id] for chunk_id in map(str, subset_ids) if chunk_id in entry.row_by_id],
+            dtype=np.intp,
+        )
+        if rows.size == 0:
+            return []
 
-        return [(chunk_id, rank + 1) for rank, (chunk_id, _) in enumerate(ranked_similarities)]
\ No newline at end of file
+        scores = entry.vectors[rows] @ query_vector
+        return cls._results(entry, rows, scores, rows.size)
@@ -0,0 +1,254 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from app.modules.user.user_util import USER_DIRECTORY, get_user_vector_directory
+from app.utils.logging_util import configure_logging
+
+logger = configure_logging()
+
+DTYPE = np.float32
+MANIFEST_NAME = "manifest.json"
+TOMBSTONES_NAME = "tombstones.txt"
+LOCK_NAME = ".lock"
+
+
+class VectorStoreSnapshot:
+    __slots__ = ("vectors", "chunk_ids", "document_ids", "tombstones", "start_row", "position", "model")
+
+    def __init__(self, vectors: np.ndarray, chunk_ids: list, document_ids: list, tombstones: set, start_row: int,
+                 position: tuple, model: str = None):
+        self.vectors = vectors  # Read-only np.memmap over every row of the generation
+        self.chunk_ids = chunk_ids  # IDs of rows start_row onwards
+        self.document_ids = document_ids  # Owning document of each of those rows
+        self.tombstones = tombstones  # Soft-deleted document IDs whose rows are awaiting compaction
+        self.start_row = start_row  # Non-zero when only rows appended after an earlier snapshot were read
+        self.position = position  # (generation, rows, index_bytes), pass back to read() to get only new rows
+        self.model = model  # DocumentEmbedding.model of every row; None for stores written before it was recorded
+
+
+class VectorStore:
+    """Append-only float32 vector file per user, shared between web and Celery processes.
+
+    Rows live in ``vectors-<generation>.f32`` with their chunk and document IDs in ``index-<generation>.tsv``.
+    ``manifest.json`` records the live generation, dimension, embedding model and row count and is replaced
+    atomically after every write, so readers never see a partially appended batch. Compaction and rewrite() write
+    a new generation, letting processes that still map the old one keep reading it until they reload.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = str(user_id)
+        self.directory = get_user_vector_directory(self.user_id)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _vector_name(generation: int) -> str:
+        return f"vectors-{generation}.f32"
+
+    @staticmethod
+    def _index_name(generation: int) -> str:
+        return f"index-{generation}.tsv"
+
+    @contextmanager
+    def _locked(self):
+        with open(self._path(LOCK_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(MANIFEST_NAME), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self, manifest: dict) -> None:
+        temp_path = self._path(f"{MANIFEST_NAME}.tmp")
+        with open(temp_path, "w") as file:
+            json.dump(manifest, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._path(MANIFEST_NAME))
+
+    def _read_tombstones(self) -> set:
+        try:
+            with open(self._path(TOMBSTONES_NAME), "r") as file:
+                return {line.strip() for line in file if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def exists(self) -> bool:
+        return os.path.exists(self._path(MANIFEST_NAME))
+
+    def append(self, chunk_ids: list, document_ids: list, vectors: np.ndarray, model: str = None) -> None:
+        """Add rows; model, when given, must match the model the store was written with."""
+        vectors = np.ascontiguousarray(vectors, dtype=DTYPE)
+        if vectors.ndim != 2 or vectors.shape[0] != len(chunk_ids) or len(chunk_ids) != len(document_ids):
+            raise ValueError("Vectors, chunk IDs and document IDs must describe the same number of rows.")
+        if not len(chunk_ids):
+            return
+
+        with self._locked():
+            manifest = self._read_manifest() or {
+                "generation": 0, "dim": vectors.shape[1], "rows": 0, "index_bytes": 0, "model": model
+            }
+            if manifest["dim"] != vectors.shape[1]:
+                raise ValueError(f"Expected vectors of dimension {manifest['dim']}, but got {vectors.shape[1]}")
+            if model is not None and manifest.get("model") not in (None, model):
+                raise ValueError(f"Expected vectors of model {manifest['model']}, but got {model}")
+
+            vector_path = self._path(self._vector_name(manifest["generation"]))
+            index_path = self._path(self._index_name(manifest["generation"]))
+            index_lines = "".join(f"{chunk_id}\t{document_id}\n" for chunk_id, document_id in zip(chunk_ids, document_ids))
+            index_bytes = index_lines.encode("utf-8")
+
+            # Drop anything a crashed writer appended past the manifest before adding our rows
+            with open(vector_path, "ab") as file:
+                file.truncate(manifest["rows"] * manifest["dim"] * DTYPE().itemsize)
+                file.write(vectors.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            with open(index_path, "ab") as file:
+                file.truncate(manifest["index_bytes"])
+                file.write(index_bytes)
+                file.flush()
+                os.fsync(file.fileno())
+
+            manifest["rows"] += len(chunk_ids)
+            manifest["index_bytes"] += len(index_bytes)
+            self._write_manifest(manifest)
+
+    def add_tombstones(self, document_ids: list) -> None:
+        if not document_ids:
+            return
+        with self._locked():
+            with open(self._path(TOMBSTONES_NAME), "a") as file:
+                file.writelines(f"{document_id}\n" for document_id in document_ids)
+
+    def read(self, after: tuple = None):
+        """Map the current generation read-only, or return None if nothing has been stored yet.
+
+        Given the position of an earlier snapshot of the same generation, only the index of rows appended since
+        is read. After a compaction the whole generation is read again.
+        """
+        for _ in range(3):
+            manifest = self._read_manifest()
+            if manifest is None:
+                return None
+            try:
+                return self._read_generation(manifest, after)
+            except FileNotFoundError:
+                # A compaction replaced this generation between reading the manifest and opening its files
+                continue
+        raise RuntimeError(f"Vector store for user {self.user_id} kept changing while being read")
+
+    def _read_generation(self, manifest: dict, after: tuple = None) -> VectorStoreSnapshot:
+        rows, dim = manifest["rows"], manifest["dim"]
+        start_row, start_byte = 0, 0
+        if after is not None and after[0] == manifest["generation"]:
+            start_row, start_byte = after[1], after[2]
+
+        with open(self._path(self._index_name(manifest["generation"])), "rb") as file:
+            file.seek(start_byte)
+            index = file.read(manifest["index_bytes"] - start_byte).decode("utf-8").splitlines()
+
+        if rows:
+            vectors = np.memmap(
+                self._path(self._vector_name(manifest["generation"])), dtype=DTYPE, mode="r", shape=(rows, dim)
+            )
+        else:
+            vectors = np.empty((0, dim), dtype=DTYPE)
+        chunk_ids, document_ids = zip(*(line.split("\t") for line in index)) if index else ((), ())
+        position = (manifest["generation"], rows, manifest["index_bytes"])
+        return VectorStoreSnapshot(
+            vectors, list(chunk_ids), list(document_ids), self._read_tombstones(), start_row, position,
+            manifest.get("model"),
+        )
+
+    def compact(self, live_documents=None) -> int:
+        """Rewrite the store without tombstoned or duplicate rows, or rows of documents live_documents() omits.
+
+        live_documents is called with the store locked, so a document that commits its first rows while the
+        store is being compacted is already in the set it returns. Returns the number of rows removed.
+        """
+        with self._locked():
+            manifest = self._read_manifest()
+            if manifest is None:
+                return 0
+            live_document_ids = live_documents() if live_documents is not None else None
+            snapshot = self.read()
+            tombstones = snapshot.tombstones
+            keep = []
+            seen = set()
+            for row, (chunk_id, document_id) in enumerate(zip(snapshot.chunk_ids, snapshot.document_ids)):
+                if document_id in tombstones or chunk_id in seen:
+                    continue
+                if live_document_ids is not None and document_id not in live_document_ids:
+                    continue
+                seen.add(chunk_id)
+                keep.append(row)
+            removed = len(snapshot.chunk_ids) - len(keep)
+            if not removed:
+                if tombstones:
+                    os.remove(self._path(TOMBSTONES_NAME))
+                return 0
+
+            vectors = np.ascontiguousarray(snapshot.vectors[keep])
+            chunk_ids = [snapshot.chunk_ids[row] for row in keep]
+            document_ids = [snapshot.document_ids[row] for row in keep]
+            del snapshot
+            self._replace_generation(manifest, chunk_ids, document_ids, vectors, manifest.get("model"))
+            return removed
+
+    def rewrite(self, chunk_ids: list, document_ids: list, vectors: np.ndarray, model: str) -> None:
+        """Replace every row with the given ones, e.g. after the user's embeddings moved to another model."""
+        vectors = np.ascontiguousarray(vectors, dtype=DTYPE)
+        if vectors.ndim != 2 or vectors.shape[0] != len(chunk_ids) or len(chunk_ids) != len(document_ids):
+            raise ValueError("Vectors, chunk IDs and document IDs must describe the same number of rows.")
+        with self._locked():
+            manifest = self._read_manifest() or {"generation": 0}
+            self._replace_generation(manifest, chunk_ids, document_ids, vectors, model)
+
+    def _replace_generation(self, manifest: dict, chunk_ids: list, document_ids: list, vectors: np.ndarray,
+                            model: str) -> None:
+        """Write the rows as the next generation and switch the manifest to it. Call with the lock held."""
+        old_generation = manifest["generation"]
+        generation = old_generation + 1
+        with open(self._path(self._vector_name(generation)), "wb") as file:
+            file.write(vectors.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        index_bytes = "".join(
+            f"{chunk_id}\t{document_id}\n" for chunk_id, document_id in zip(chunk_ids, document_ids)
+        ).encode("utf-8")
+        with open(self._path(self._index_name(generation)), "wb") as file:
+            file.write(index_bytes)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._write_manifest({
+            "generation": generation, "dim": vectors.shape[1], "rows": len(chunk_ids), "index_bytes": len(index_bytes),
+            "model": model,
+        })
+        if os.path.exists(self._path(TOMBSTONES_NAME)):
+            os.remove(self._path(TOMBSTONES_NAME))
+
+        # Processes still mapping the old generation keep their open file until they reload
+        for name in (self._vector_name(old_generation), self._index_name(old_generation)):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+
+
+def iter_user_stores():
+    """Yield a VectorStore for every user directory that has one."""
+    for user_id in os.listdir(USER_DIRECTORY):
+        if os.path.exists(os.path.join(USER_DIRECTORY, user_id, "vectors", MANIFEST_NAME)):
+            yield VectorStore(user_id)
@@ -0,0 +1,297 @@
+"""Retrieval benchmark for VectorCache and both find_relevant_sections variants.
+
+Builds synthetic users holding 1k to 1M random unit vectors, with matching Document, DocumentChunk and
+DocumentEmbedding rows in a throwaway SQLite schema, then times:
+
+    load_cold       VectorCache.load_user_vectors after evicting the user (store read, no backfill)
+    load_warm       VectorCache.load_user_vectors with the entry cached (version check only)
+    mips_naive      VectorCache.mips_naive over --subset random chunk IDs
+    top_k           VectorCache.top_k with the configured IVF / prefix / compact / routing settings
+    chat_sections   app.modules.embedding.embedding_util.find_relevant_sections
+    cwd_sections    app.modules.cwd.cwd_util.find_relevant_sections
+
+Each stage reports p50/p95/mean latency in milliseconds; top_k also reports recall@k against exact search, and
+every size records cache bytes and process peak RSS. Results are written as JSON so runs can be diffed:
+
+    python -m benchmarks.retrieval_benchmark --sizes 1000,10000,100000 --output before.json
+
+A 1M-row run at 3072 dimensions needs roughly 25 GB of disk for the database and vector store.
+
+--database-url points the run at another database instead. Every app table in it is dropped afterwards, so it
+must be a scratch database and the run also needs --i-know-this-drops-tables.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+
+os.environ.setdefault("SQL_PASSWORD", "")  # config.py URL-encodes it at import time; SQLite never uses it
+
+from flask import Flask  # noqa: E402
+
+from app import db  # noqa: E402
+from app.models import audio_models, chat_models, image_models, task_models  # noqa: E402,F401
+from app.models.embedding_models import Document, DocumentChunk, DocumentEmbedding, ModelContextWindow  # noqa: E402
+from app.models.user_models import User  # noqa: E402
+from app.modules.user.user_util import USER_DIRECTORY  # noqa: E402
+from app.utils.quantization import normalize  # noqa: E402
+from app.utils.search_batcher import SearchBatcher  # noqa: E402
+from app.utils.vector_cache import VectorCache  # noqa: E402
+from config import Config  # noqa: E402
+
+MODEL_NAME = "benchmark-model"
+CHUNK_TOKENS = 256
+CHUNK_CONTENT = "benchmark " * 200  # ~2 KB per chunk, roughly what a 512-token chunk weighs
+INSERT_BATCH = 2000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma-separated chunk counts per user")
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--chunks-per-document", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--subset", type=int, default=1000, help="Chunk IDs scored per mips_naive call")
+    parser.add_argument("--database-url", default=None, help="Defaults to a SQLite file in a temporary directory")
+    parser.add_argument("--i-know-this-drops-tables", action="store_true",
+                        help="Required with --database-url: every app table in that database is dropped afterwards")
+    parser.add_argument("--batch-window-ms", type=float, default=0.0,
+                        help="SearchBatcher window; 0 measures single-query latency without batching")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="retrieval-benchmark.json")
+    args = parser.parse_args()
+    if args.database_url and not args.i_know_this_drops_tables:
+        parser.error("--database-url drops every app table in that database; pass --i-know-this-drops-tables")
+    return args
+
+
+def random_unit_vectors(rng, rows: int, dim: int) -> np.ndarray:
+    vectors = rng.standard_normal((rows, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def summarize(samples: list) -> dict:
+    milliseconds = np.array(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 3),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 3),
+        "mean_ms": round(float(milliseconds.mean()), 3),
+        "runs": len(samples),
+    }
+
+
+def timed(function, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def create_user(rng, rows: int, dim: int, chunks_per_document: int):
+    """Insert a user with `rows` chunks and embeddings. Returns (user_id, chunk_ids, vectors)."""
+    user_id = str(uuid.uuid4())
+    # VectorCache only loads embeddings of the user's active model
+    db.session.add(User(
+        id=user_id, username=user_id[:20], email=f"{user_id}@benchmark.invalid", password_hash="x",
+        embedding_model=MODEL_NAME,
+    ))
+    vectors = random_unit_vectors(rng, rows, dim)
+    chunk_ids = [str(uuid.uuid4()) for _ in range(rows)]
+
+    for document_start in range(0, rows, chunks_per_document):
+        document_rows = range(document_start, min(document_start + chunks_per_document, rows))
+        document_id = str(uuid.uuid4())
+        db.session.execute(
+            Document.__table__.insert(),
+            [{
+                "id": document_id, "user_id": user_id, "title": f"Document {document_start // chunks_per_document}",
+                "total_tokens": len(document_rows) * CHUNK_TOKENS, "selected": True, "delete": False,
+                "centroid": normalize(vectors[document_rows.start:document_rows.stop].mean(axis=0)).tobytes(),
+            }],
+        )
+        for batch_start in range(document_rows.start, document_rows.stop, INSERT_BATCH):
+            batch = range(batch_start, min(batch_start + INSERT_BATCH, document_rows.stop))
+            db.session.execute(
+                DocumentChunk.__table__.insert(),
+                [{
+                    "id": chunk_ids[row], "document_id": document_id, "chunk_index": row - document_rows.start,
+                    "content": CHUNK_CONTENT, "tokens": CHUNK_TOKENS, "pages": "1",
+                } for row in batch],
+            )
+            db.session.execute(
+                DocumentEmbedding.__table__.insert(),
+                [{
+                    "id": str(uuid.uuid4()), "user_id": user_id, "chunk_id": chunk_ids[row],
+                    "embedding": vectors[row].tobytes(), "model": MODEL_NAME, "storage_format": "float32",
+                } for row in batch],
+            )
+    db.session.commit()
+    return user_id, chunk_ids, vectors
+
+
+def exact_top_k(vectors: np.ndarray, query_vector: np.ndarray, k: int) -> set:
+    scores = vectors @ query_vector
+    return set(np.argpartition(scores, -k)[-k:].tolist()) if k < scores.size else set(range(scores.size))
+
+
+def benchmark_size(rng, rows: int, args) -> dict:
+    from app.modules.cwd import cwd_util
+    from app.modules.embedding import embedding_util
+
+    started = time.perf_counter()
+    user_id, chunk_ids, vectors = create_user(rng, rows, args.dim, args.chunks_per_document)
+    insert_seconds = time.perf_counter() - started
+    row_by_id = {chunk_id: row for row, chunk_id in enumerate(chunk_ids)}
+
+    try:
+        VectorCache.evict_user(user_id)
+        started = time.perf_counter()
+        VectorCache.load_user_vectors(user_id)  # First load copies the database rows into the vector store
+        backfill_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        ann_built = VectorCache.build_ann_index(user_id)
+        ann_seconds = time.perf_counter() - started
+
+        def load_cold():
+            VectorCache.evict_user(user_id)
+            VectorCache.load_user_vectors(user_id)
+
+        stages = {"load_cold": timed(load_cold, min(args.queries, 10))}
+        stages["load_warm"] = timed(lambda: VectorCache.load_user_vectors(user_id), args.queries)
+        entry = VectorCache.get_user_vectors(user_id)
+
+        queries = random_unit_vectors(rng, args.queries, args.dim)
+        subsets = iter([
+            rng.choice(chunk_ids, min(args.subset, rows), replace=False).tolist() for _ in range(args.queries)
+        ])
+        query_iter = iter(queries)
+        stages["mips_naive"] = timed(
+            lambda: VectorCache.mips_naive(user_id, next(query_iter), next(subsets)), args.queries
+        )
+
+        samples, recalls = [], []
+        for query_vector in queries:
+            started = time.perf_counter()
+            results = VectorCache.top_k(user_id, query_vector, args.k)
+            samples.append(time.perf_counter() - started)
+            found = {row_by_id[chunk_id] for chunk_id, _ in results}
+            expected = exact_top_k(vectors, query_vector, args.k)
+            recalls.append(len(found & expected) / len(expected))
+        stages["top_k"] = dict(summarize(samples), recall_at_k=round(float(np.mean(recalls)), 4))
+
+        preferences = SimpleNamespace(model=MODEL_NAME, top_k=args.k, threshold=-1.0)
+        for stage, module in (("chat_sections", embedding_util), ("cwd_sections", cwd_util)):
+            query_iter = iter(queries)
+            stages[stage] = timed(
+                lambda: module.find_relevant_sections(user_id, next(query_iter), preferences), args.queries
+            )
+
+        return {
+            "rows": rows,
+            "documents": len(entry.document_ids),
+            "insert_seconds": round(insert_seconds, 3),
+            "first_load_seconds": round(backfill_seconds, 3),
+            "ann_index": {"built": ann_built, "seconds": round(ann_seconds, 3)},
+            "cache_bytes": entry.nbytes,
+            "vector_bytes": int(vectors.nbytes),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": stages,
+        }
+    finally:
+        VectorCache.evict_user(user_id)
+        shutil.rmtree(os.path.join(USER_DIRECTORY, user_id), ignore_errors=True)
+
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    workdir = tempfile.mkdtemp(prefix="retrieval-benchmark-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=database_url, SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db.init_app(app)
+    VectorCache.configure(
+        max_bytes=Config.VECTOR_CACHE_MAX_BYTES,
+        ann_min_rows=Config.VECTOR_ANN_MIN_ROWS,
+        ann_nprobe=Config.VECTOR_ANN_NPROBE,
+        cache_format=Config.VECTOR_CACHE_FORMAT,
+        coarse_dimensions=Config.VECTOR_COARSE_DIMENSIONS,
+        coarse_candidates=Config.VECTOR_COARSE_CANDIDATES,
+        route_fanout=Config.VECTOR_ROUTE_FANOUT,
+        route_min_rows=Config.VECTOR_ROUTE_MIN_ROWS,
+    )
+    SearchBatcher.configure(window=args.batch_window_ms / 1000)
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.add(ModelContextWindow(model_name=MODEL_NAME, context_window_size=args.k * CHUNK_TOKENS * 2))
+            db.session.commit()
+            for rows in sizes:
+                print(f"Benchmarking {rows} rows of dimension {args.dim}...", flush=True)
+                result = benchmark_size(rng, rows, args)
+                results.append(result)
+                print(json.dumps(result["stages"], indent=2), flush=True)
+            if args.database_url:
+                db.drop_all()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "parameters": {
+            "dim": args.dim, "k": args.k, "queries": args.queries, "subset": args.subset,
+            "chunks_per_document": args.chunks_per_document, "batch_window_ms": args.batch_window_ms,
+            "seed": args.seed,
+        },
+        "vector_cache": {
+            "cache_format": VectorCache.cache_format,
+            "ann_min_rows": VectorCache.ann_min_rows,
+            "ann_nprobe": VectorCache.ann_nprobe,
+            "coarse_dimensions": VectorCache.coarse_dimensions,
+            "route_fanout": VectorCache.route_fanout,
+            "route_min_rows": VectorCache.route_min_rows,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Splitting benchmark: TextSplitter against TokenTextSplitter.
+
+Extracts every page of --pdf once (or generates --pages synthetic pages when no PDF is given), then times
+splitting the in-memory pages with:
+
+    legacy          TextSplitter, one add_text call per page (sent_tokenize, count_tokens per sentence)
+    token_nltk      TokenTextSplitter with sentence_splitter="nltk", pages added in batches of --page-batch
+    token_regex     TokenTextSplitter with sentence_splitter="regex"
+
+Each splitter reports p50/mean seconds over --repeat runs, pages per second, chunk count, token total and the
+share of source words that survive splitting. Results are written as JSON so runs can be diffed:
+
+    python -m benchmarks.splitter_benchmark --pdf paper-collection.pdf --max-tokens 512 --output splitter.json
+
+GPT preprocessing is off, so no API key is needed.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault("SQL_PASSWORD", "")  # config.py URL-encodes it at import time
+
+from app.models import audio_models, chat_models, image_models, task_models, user_models  # noqa: E402,F401
+from app.modules.embedding.embedding_util import (  # noqa: E402
+    TextExtractor,
+    TextSplitter,
+    TokenTextSplitter,
+    download_nltk_data,
+    preprocess_text,
+)
+from app.modules.embedding.ingestion_pipeline import PAGE_BATCH_SIZE  # noqa: E402
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are from or an at which but not have has were "
+    "model data results method analysis table figure section shows using based between these than their"
+).split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", default=None, help="PDF to split; ideally several hundred pages")
+    parser.add_argument("--pages", type=int, default=400, help="Synthetic pages when no --pdf is given")
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--page-batch", type=int, default=PAGE_BATCH_SIZE)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="splitter-benchmark.json")
+    return parser.parse_args()
+
+
+def synthetic_pages(page_count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    pages = []
+    for page_number in range(1, page_count + 1):
+        sentences = []
+        for _ in range(rng.randint(15, 30)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(5, 40))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        pages.append(("\n".join(sentences), page_number))
+    return pages
+
+
+def run_splitter(make_splitter, pages: list, page_batch: int) -> tuple:
+    splitter = make_splitter()
+    chunks = []
+    if isinstance(splitter, TokenTextSplitter):
+        for start in range(0, len(pages), page_batch):
+            splitter.add_pages(pages[start:start + page_batch])
+            chunks.extend(splitter.drain())
+    else:
+        for text, page_number in pages:
+            splitter.add_text(text, page_number)
+            chunks.extend(splitter.drain())
+    chunks.extend(splitter.drain(final=True, page_number=pages[-1][1] if pages else None))
+    return chunks
+
+
+def bench(name: str, make_splitter, pages: list, args, source_words: int) -> dict:
+    timings = []
+    chunks = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        chunks = run_splitter(make_splitter, pages, args.page_batch)
+        timings.append(time.perf_counter() - started)
+
+    kept_words = sum(len(chunk.split()) for chunk, _, _ in chunks)
+    result = {
+        "p50_s": statistics.median(timings),
+        "mean_s": statistics.fmean(timings),
+        "pages_per_s": len(pages) / statistics.median(timings),
+        "chunks": len(chunks),
+        "tokens": sum(tokens for _, _, tokens in chunks),
+        "max_chunk_tokens": max((tokens for _, _, tokens in chunks), default=0),
+        "word_retention": kept_words / source_words if source_words else None,
+    }
+    print(
+        f"{name:<12} p50 {result['p50_s']:.3f}s  {result['pages_per_s']:.0f} pages/s  {result['chunks']} chunks  "
+        f"{result['tokens']} tokens  words kept {result['word_retention']:.3f}"
+    )
+    return result
+
+
+def main():
+    args = parse_args()
+    download_nltk_data()
+    if args.pdf:
+        pages = list(TextExtractor(args.pdf).extract_text_from_file())
+        filepath = args.pdf
+    else:
+        pages = synthetic_pages(args.pages, args.seed)
+        filepath = "synthetic.pdf"
+    source_words = sum(len(preprocess_text(text).split()) for text, _ in pages)
+    print(f"{len(pages)} pages, {source_words} words, max_tokens {args.max_tokens}")
+
+    splitters = {
+        "legacy": lambda: TextSplitter(max_tokens=args.max_tokens, filepath=filepath),
+        "token_nltk": lambda: TokenTextSplitter(max_tokens=args.max_tokens, filepath=filepath),
+        "token_regex": lambda: TokenTextSplitter(
+            max_tokens=args.max_tokens, filepath=filepath, sentence_splitter="regex"
+        ),
+    }
+    results = {name: bench(name, make_splitter, pages, args, source_words) for name, make_splitter in splitters.items()}
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "args": vars(args),
+        "pages": len(pages),
+        "source_words": source_words,
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -35,6 +35,7 @@ class Config(object):
         "app.tasks.image_task",
         "app.tasks.deletion_task",
         "app.tasks.embedding_task",
+        "app.tasks.embedding_migration_task",
         "app.tasks.celerybeat_task",
     )
 
@@ -55,8 +56,49 @@ class Config(object):
             "task": "app.tasks.celerybeat_task.cleanup_transcription",  # Use the correct path to your task function
             "schedule": crontab(minute="4", hour="*/3"),  # At minute 0 past hour 0 and 12.
         },
+        "periodic_vector_store_compaction": {
+            "task": "app.tasks.celerybeat_task.compact_vector_stores",
+            "schedule": crontab(minute="5", hour="*/6"),
+        },
     }
 
+    VECTOR_CACHE_MAX_BYTES = int(os.getenv("VECTOR_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+    VECTOR_ANN_MIN_ROWS = int(os.getenv("VECTOR_ANN_MIN_ROWS", 20000))
+    VECTOR_ANN_NPROBE = int(os.getenv("VECTOR_ANN_NPROBE", 8))
+    EMBEDDING_STORAGE_FORMAT = os.getenv("EMBEDDING_STORAGE_FORMAT", "float32")  # float32, float16 or int8
+    VECTOR_CACHE_FORMAT = os.getenv("VECTOR_CACHE_FORMAT", "float32")  # float32, float16 or int8
+    # Matryoshka prefix size for the first retrieval pass unless the tier's embed_dimensions overrides it; 0 = off
+    VECTOR_COARSE_DIMENSIONS = int(os.getenv("VECTOR_COARSE_DIMENSIONS", 0))
+    VECTOR_COARSE_CANDIDATES = int(os.getenv("VECTOR_COARSE_CANDIDATES", 256))
+    # Large selections only search chunks of the best-matching documents by centroid; fan-out 0 disables it
+    VECTOR_ROUTE_FANOUT = int(os.getenv("VECTOR_ROUTE_FANOUT", 8))
+    VECTOR_ROUTE_MIN_ROWS = int(os.getenv("VECTOR_ROUTE_MIN_ROWS", 20000))
+    # Concurrent knowledge queries arriving within this window share one matrix product; 0 disables batching
+    VECTOR_SEARCH_BATCH_WINDOW_MS = float(os.getenv("VECTOR_SEARCH_BATCH_WINDOW_MS", 2))
+    VECTOR_SEARCH_MAX_BATCH = int(os.getenv("VECTOR_SEARCH_MAX_BATCH", 32))
+    # Processes extracting PDF pages in parallel per Celery worker process; 0 or 1 extracts serially. Off by
+    # default: under --pool=eventlet one spawned pool, each child re-importing the app, would serve every green
+    # thread, and large PDFs are already spread over workers by the page-range fan-out (EMBEDDING_FANOUT_*).
+    # Set it only for workers started with --pool=prefork, e.g. min(4, cpus) divided by --concurrency.
+    PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", 0))
+    PDF_EXTRACTION_MIN_PAGES = int(os.getenv("PDF_EXTRACTION_MIN_PAGES", 64))
+    # "nltk" (sent_tokenize) or "regex", a faster segmenter that only splits after . ! ? followed by whitespace
+    EMBEDDING_SENTENCE_SPLITTER = os.getenv("EMBEDDING_SENTENCE_SPLITTER", "nltk")
+    # Chunks never span a multiple of this many pages, so an interrupted embedding task can resume there
+    EMBEDDING_CHECKPOINT_PAGES = int(os.getenv("EMBEDDING_CHECKPOINT_PAGES", 10))
+    # PDFs with at least this many pages are embedded as parallel page-range tasks
+    EMBEDDING_FANOUT_MIN_PAGES = int(os.getenv("EMBEDDING_FANOUT_MIN_PAGES", 150))
+    EMBEDDING_FANOUT_PAGES_PER_TASK = int(os.getenv("EMBEDDING_FANOUT_PAGES_PER_TASK", 50))
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+    QUERY_EMBEDDING_CACHE_DIR = os.getenv("QUERY_EMBEDDING_CACHE_DIR")  # Optional on-disk tier shared by workers
+    # GPT preprocessing requests in flight per worker process, shared by every document being embedded
+    GPT_PREPROCESS_WORKERS = int(os.getenv("GPT_PREPROCESS_WORKERS", 8))
+    # Reuse embeddings of identical uploads and chunks (same text, chunk size and model) across users
+    CHUNK_EMBEDDING_CACHE_ENABLED = os.getenv("CHUNK_EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    # Background re-embedding after a model change: chunks per batch and seconds between a user's batches
+    EMBEDDING_MIGRATION_BATCH_CHUNKS = int(os.getenv("EMBEDDING_MIGRATION_BATCH_CHUNKS", 500))
+    EMBEDDING_MIGRATION_BATCH_DELAY = float(os.getenv("EMBEDDING_MIGRATION_BATCH_DELAY", 2))
+
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = "Lax"
 